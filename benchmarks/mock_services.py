@@ -0,0 +1,339 @@
+# This file contains local stand-ins for the Azure OpenAI chat completion and
+# embedding endpoints and the Azure Cognitive Search query endpoint, used to
+# benchmark the pipeline without live services. Each endpoint has a configurable
+# latency distribution, token rate and error/429 rate. The random draws depend
+# on the seed and the request, not on the order of concurrent requests, so
+# runs are reproducible. To run the mocks on their own, e.g. to point chat.py at
+# them: python mock_services.py --port 8000
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+# Latency and error settings per service. latency_ms is the median latency of
+# a response, or of the first token of a chat completion, and sigma the spread
+# of its log-normal distribution.
+DEFAULT_PROFILES = {
+    "chat": {
+        "latency_ms": 400,
+        "sigma": 0.4,
+        "tokens_per_second": 60,
+        "answer_tokens": 80,
+        "throttle_rate": 0.0,
+        "error_rate": 0.0,
+        "retry_after": 1,
+    },
+    "embedding": {
+        "latency_ms": 40,
+        "sigma": 0.3,
+        "throttle_rate": 0.0,
+        "error_rate": 0.0,
+        "retry_after": 1,
+    },
+    "search": {
+        "latency_ms": 80,
+        "sigma": 0.3,
+        "throttle_rate": 0.0,
+        "error_rate": 0.0,
+        "retry_after": 1,
+    },
+}
+
+EMBEDDING_DIMENSIONS = 1536
+WORDS = (
+    "plan coverage deductible premium employee benefits dental vision medical "
+    "network provider copay claim policy manager review vacation leave payroll "
+    "holiday prescription hospital emergency preventive care annual limit "
+    "northwind standard health plus handbook role responsibility"
+).split()
+
+
+def load_profiles(path: str = None, throttle_rate=None, error_rate=None) -> dict:
+    """
+    Return the default profiles, updated from a JSON file with the same layout
+    and with the throttle and error rates of all services, if given.
+    """
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    if path is not None:
+        with open(path, "r") as f:
+            for name, profile in json.load(f).items():
+                profiles[name].update(profile)
+    for profile in profiles.values():
+        if throttle_rate is not None:
+            profile["throttle_rate"] = throttle_rate
+        if error_rate is not None:
+            profile["error_rate"] = error_rate
+    return profiles
+
+
+class MockServices:
+    """
+    An aiohttp application serving the mock endpoints, with request counters
+    per service.
+    """
+
+    def __init__(self, profiles: dict = None, seed: int = 0, documents: int = 200):
+        self.profiles = profiles or load_profiles()
+        self.seed = seed
+        self.documents = [self._document(i) for i in range(documents)]
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self._occurrences = defaultdict(int)
+
+    def _document(self, i: int) -> dict:
+        rng = random.Random(f"{self.seed}:document:{i}")
+        words = [rng.choice(WORDS) for _ in range(160)]
+        return {
+            "id": f"doc-{i}",
+            "content": " ".join(words).capitalize() + ".",
+            "category": "benchmark",
+            "source_page": f"benefits-{i // 10}.pdf#page={i % 10 + 1}",
+            "source_file": f"benefits-{i // 10}.pdf",
+        }
+
+    def _random(self, service: str, body: bytes) -> random.Random:
+        """
+        Return a random generator for a request, seeded with its content and
+        the number of times the same request was made, e.g. by a retry.
+        """
+        key = hashlib.sha256(body).hexdigest()
+        self._occurrences[(service, key)] += 1
+        return random.Random(
+            f"{self.seed}:{service}:{key}:{self._occurrences[(service, key)]}"
+        )
+
+    def _latency(self, profile: dict, rng: random.Random) -> float:
+        return profile["latency_ms"] / 1000 * math.exp(rng.gauss(0, profile["sigma"]))
+
+    async def _begin(self, service: str, request: web.Request):
+        """
+        Count the request, and return an error response if the request is
+        throttled or fails, else the profile and random generator to use.
+        """
+        body = await request.read()
+        profile = self.profiles[service]
+        rng = self._random(service, body)
+        stats = self.stats[service]
+        stats["requests"] += 1
+
+        draw = rng.random()
+        if draw < profile["throttle_rate"]:
+            stats["throttled"] += 1
+            await asyncio.sleep(self._latency(profile, rng) / 4)
+            error = web.json_response(
+                {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                status=429,
+                headers={"Retry-After": str(profile["retry_after"])},
+            )
+            return error, None
+        if draw < profile["throttle_rate"] + profile["error_rate"]:
+            stats["errors"] += 1
+            await asyncio.sleep(self._latency(profile, rng))
+            error = web.json_response(
+                {"error": {"code": "500", "message": "Internal server error."}},
+                status=500,
+            )
+            return error, None
+        return None, (json.loads(body or b"{}"), profile, rng)
+
+    # Chat completions
+
+    @staticmethod
+    def _chat_reply(messages: list, rng: random.Random, answer_tokens: int) -> str:
+        """Reply in the way the planner, the query writer or the answer would."""
+        system = " ".join(m["content"] for m in messages if m["role"] == "system")
+        question = next(
+            (m["content"] for m in reversed(messages) if m["role"] == "user"), ""
+        ).lower()
+        words = [w.strip("?.,!") for w in question.split()]
+        search_query = " ".join(w for w in words if len(w) > 3)[:60]
+        if "planning assistant" in system:
+            if any(word in question for word in ("joke", "story", "poem")):
+                plan = ["knowledge_base_search.safety_share"]
+            elif any(word in question for word in ("weather", "stock", "recipe")):
+                plan = []
+            else:
+                plan = [
+                    "knowledge_base_search.create_search_query",
+                    "acs_plugin.search",
+                    "knowledge_base_search.create_answer",
+                ]
+            if '"search_query"' in system:
+                # The fused planner also creates the search query
+                if "acs_plugin.search" not in plan:
+                    search_query = ""
+                return json.dumps({"plan": plan, "search_query": search_query})
+            return json.dumps(plan)
+        if "search query generator" in system:
+            return search_query or "0"
+
+        count = max(1, int(rng.gauss(answer_tokens, answer_tokens / 4)))
+        words = [rng.choice(WORDS) for _ in range(count)]
+        return " ".join(words).capitalize() + ". [benefits-0.pdf#page=1]"
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        error, begun = await self._begin("chat", request)
+        if error is not None:
+            return error
+        body, profile, rng = begun
+        reply = self._chat_reply(body["messages"], rng, profile["answer_tokens"])
+        tokens = reply.split(" ")
+        completion = {
+            "id": f"chatcmpl-{rng.getrandbits(32):08x}",
+            "created": int(time.time()),
+            "model": "gpt-35-turbo",
+        }
+        self.stats["chat"]["completion_tokens"] += len(tokens)
+
+        await asyncio.sleep(self._latency(profile, rng))
+        token_delay = 1 / profile["tokens_per_second"]
+        if not body.get("stream"):
+            await asyncio.sleep(token_delay * len(tokens))
+            completion.update(
+                {
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": reply},
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": len(tokens),
+                        "total_tokens": len(tokens),
+                    },
+                }
+            )
+            return web.json_response(completion)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        completion["object"] = "chat.completion.chunk"
+        deltas = [{"role": "assistant"}]
+        deltas += [
+            {"content": token if i == 0 else " " + token}
+            for i, token in enumerate(tokens)
+        ]
+        for i, delta in enumerate(deltas):
+            if i > 1:
+                await asyncio.sleep(token_delay)
+            chunk = dict(
+                completion,
+                choices=[{"index": 0, "finish_reason": None, "delta": delta}],
+            )
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        chunk = dict(
+            completion, choices=[{"index": 0, "finish_reason": "stop", "delta": {}}]
+        )
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    # Embeddings
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        error, begun = await self._begin("embedding", request)
+        if error is not None:
+            return error
+        body, profile, rng = begun
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(self._latency(profile, rng))
+
+        data = []
+        for i, text in enumerate(texts):
+            # The same text always has the same embedding
+            text_rng = random.Random(f"{self.seed}:embedding:{text}")
+            vector = [text_rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+            norm = math.sqrt(sum(v * v for v in vector))
+            data.append(
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": [v / norm for v in vector],
+                }
+            )
+        tokens = sum(len(text.split()) for text in texts)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": data,
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    # Search
+
+    async def search(self, request: web.Request) -> web.Response:
+        error, begun = await self._begin("search", request)
+        if error is not None:
+            return error
+        body, profile, rng = begun
+        await asyncio.sleep(self._latency(profile, rng))
+
+        # Pick the results from the query, so the same query has the same results
+        query_rng = random.Random(f"{self.seed}:search:{body.get('search')}")
+        top = body.get("top") or 5
+        documents = query_rng.sample(self.documents, min(top, len(self.documents)))
+        value = [
+            dict(document, **{"@search.score": 1 / (rank + 1)})
+            for rank, document in enumerate(documents)
+        ]
+        return web.json_response({"value": value})
+
+    def stats_summary(self) -> dict:
+        summary = {}
+        for service, stats in self.stats.items():
+            requests = stats["requests"] or 1
+            summary[service] = dict(stats)
+            summary[service]["throttle_rate"] = stats["throttled"] / requests
+            summary[service]["error_rate"] = stats["errors"] / requests
+        return summary
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post(
+                    "/openai/deployments/{deployment}/chat/completions",
+                    self.chat_completions,
+                ),
+                web.post(
+                    "/openai/deployments/{deployment}/embeddings", self.embeddings
+                ),
+                # e.g. /indexes('name')/docs/search.post.search
+                web.post("/indexes{path:.*}/docs/search.post.search", self.search),
+            ]
+        )
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--profile", type=str, default=None, help="JSON file of service profiles"
+    )
+    parser.add_argument(
+        "--throttle_rate", type=float, default=None, help="429 rate of all services"
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=None, help="500 rate of all services"
+    )
+    args = parser.parse_args()
+
+    profiles = load_profiles(args.profile, args.throttle_rate, args.error_rate)
+    web.run_app(
+        MockServices(profiles, args.seed).create_app(), host=args.host, port=args.port
+    )
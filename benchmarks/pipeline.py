@@ -0,0 +1,373 @@
+# This is an end-to-end benchmark of the chat pipeline. It runs the real
+# Orchestrator against local stand-ins for Azure OpenAI and Azure Cognitive
+# Search (see mock_services.py), with a corpus of questions asked by concurrent
+# users, and reports the per-turn latency, the throughput and the latency of
+# each step. Save a run with --output and compare a later run with it with
+# --compare to catch regressions. To run it:
+# python pipeline.py --turns 200 --concurrency 8 --output baseline.json
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+from mock_services import MockServices, load_profiles
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+DEFAULT_QUESTIONS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "questions.txt"
+)
+
+
+class MockServer(threading.Thread):
+    """
+    Serves the mock services from their own event loop, so that they do not
+    compete with the benchmarked pipeline.
+    """
+
+    def __init__(self, services: MockServices):
+        super().__init__(daemon=True)
+        self.services = services
+        self.port = None
+        self._ready = threading.Event()
+        self._loop = None
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        runner = web.AppRunner(self.services.create_app())
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(runner.cleanup())
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.join()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+def percentiles(values: list) -> dict:
+    """Return the p50, p95 and p99 of a list of values, by nearest rank."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    result = {}
+    for q in (50, 95, 99):
+        rank = max(0, min(len(values) - 1, int(q / 100 * len(values) + 0.5) - 1))
+        result[f"p{q}"] = round(values[rank], 4)
+    return result
+
+
+def create_pipeline(
+    url: str,
+    turns: int,
+    answer_cache: bool = False,
+    fused_planner: bool = False,
+    speculative_search: bool = False,
+):
+    """
+    Create the app with its services pointed at the mocks, and return the
+    orchestrator and a session manager.
+    """
+    sys.path.insert(0, SRC_DIRECTORY)
+    # The plugins are loaded relative to the src directory
+    os.chdir(SRC_DIRECTORY)
+    import semantic_kernel.connectors.ai.open_ai as sk_oai
+
+    from app import PLUGIN_PARENT_DIRECTORY, SEMANTIC_PLUGINS, create_app
+    from sessions import SessionManager
+    from tracing import Tracer
+
+    config = {
+        "AZURE_OPENAI_ENDPOINT": url,
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT": "embedding",
+        "AZURE_SEARCH_ENDPOINT": url,
+        "AZURE_SEARCH_KEY": "benchmark",
+        "AZURE_SEARCH_INDEX": "benchmark",
+        "AZURE_SEARCH_CONTENT_FIELD": "content",
+        "AZURE_SEARCH_REFERENCE_FIELD": "source_page",
+        # Start every run with an empty embedding cache
+        "EMBEDDING_CACHE_PATH": ":memory:",
+        # The corpus repeats questions, which the answer cache would answer
+        "ANSWER_CACHE": "true" if answer_cache else "false",
+        "FUSED_PLANNER": "true" if fused_planner else "false",
+        "SPECULATIVE_SEARCH": "true" if speculative_search else "false",
+    }
+    # The Azure chat service only accepts https endpoints
+    chat_service = sk_oai.OpenAIChatCompletion(
+        "chat",
+        "benchmark",
+        api_type="azure",
+        api_version="2023-03-15-preview",
+        endpoint=url,
+    )
+    app = create_app(config, chat_service)
+    orchestrator = app["orchestrator"]
+    # Keep the traces of all turns
+    orchestrator.tracer = Tracer(max_traces=turns)
+    sessions = SessionManager(
+        app["kernel"], SEMANTIC_PLUGINS, PLUGIN_PARENT_DIRECTORY, max_sessions=turns
+    )
+    return app, orchestrator, sessions
+
+
+async def run_user(orchestrator, session, questions: list, results: list):
+    """Ask the questions of one user, one turn at a time."""
+    for question in questions:
+        start = time.perf_counter()
+        first_token = None
+
+        def on_token(token):
+            nonlocal first_token
+            if first_token is None:
+                first_token = time.perf_counter()
+
+        result = {"question": question, "error": None}
+        try:
+            await orchestrator.process_request_stream_async(
+                question, on_token, session
+            )
+        except Exception as e:
+            result["error"] = type(e).__name__
+        end = time.perf_counter()
+        result["latency"] = end - start
+        result["first_token"] = (first_token or end) - start
+        results.append(result)
+
+
+async def run_benchmark(orchestrator, sessions, questions: list, concurrency: int):
+    results = []
+    users = [questions[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            run_user(orchestrator, sessions.create(), user_questions, results)
+            for user_questions in users
+            if user_questions
+        )
+    )
+    return results, time.perf_counter() - start
+
+
+def summarize(results: list, duration: float, traces: list, services: dict) -> dict:
+    succeeded = [r for r in results if r["error"] is None]
+    stages = defaultdict(list)
+    plan_sources = Counter()
+    for trace in traces:
+        for span in trace.spans:
+            if span.duration is not None:
+                stages[span.name].append(span.duration)
+            if span.name == "planner":
+                plan_sources[span.attributes.get("source", "unknown")] += 1
+
+    return {
+        "turns": len(results),
+        "failed": len(results) - len(succeeded),
+        "errors": dict(Counter(r["error"] for r in results if r["error"])),
+        "duration": round(duration, 3),
+        "throughput": round(len(succeeded) / duration, 3) if duration else 0.0,
+        "latency": percentiles([r["latency"] for r in succeeded]),
+        "first_token": percentiles([r["first_token"] for r in succeeded]),
+        "stages": {
+            name: dict(count=len(durations), **percentiles(durations))
+            for name, durations in sorted(stages.items())
+        },
+        "plan_sources": dict(plan_sources),
+        "services": services,
+    }
+
+
+def print_summary(summary: dict):
+    print(
+        f"Turns: {summary['turns']}, failed: {summary['failed']} "
+        f"{summary['errors'] or ''}"
+    )
+    print(
+        f"Duration: {summary['duration']:.2f}s, "
+        f"throughput: {summary['throughput']:.2f} turns/s"
+    )
+    print(f"Plan sources: {summary['plan_sources']}")
+    speculation = summary.get("speculative_search", {})
+    if speculation.get("started"):
+        print(
+            f"Speculative searches: {speculation['started']}, used: "
+            f"{speculation['used']}, unused: {speculation['unused']}, "
+            f"waste rate: {speculation['waste_rate']:.2f}"
+        )
+    print(f"\n{'':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    rows = [
+        ("turn", dict(count=summary["turns"], **summary["latency"])),
+        ("first token", dict(count=summary["turns"], **summary["first_token"])),
+    ]
+    rows += sorted(summary["stages"].items())
+    for name, row in rows:
+        values = [
+            f"{row[q]:.3f}" if row[q] is not None else "-"
+            for q in ("p50", "p95", "p99")
+        ]
+        print(f"{name:<22}{row['count']:>8}" + "".join(f"{v:>10}" for v in values))
+
+    print(f"\n{'service':<22}{'requests':>10}{'429 rate':>10}{'error rate':>12}")
+    for name, stats in sorted(summary["services"].items()):
+        print(
+            f"{name:<22}{stats['requests']:>10}{stats['throttle_rate']:>10.3f}"
+            f"{stats['error_rate']:>12.3f}"
+        )
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return the latencies that are more than tolerance slower than in the
+    baseline, and a drop in throughput.
+    """
+    regressions = []
+    rows = {"turn": (summary["latency"], baseline["latency"])}
+    rows["first token"] = (summary["first_token"], baseline["first_token"])
+    for name, stage in summary["stages"].items():
+        if name in baseline["stages"]:
+            rows[name] = (stage, baseline["stages"][name])
+    for name, (current, previous) in rows.items():
+        for q in ("p50", "p95", "p99"):
+            if current[q] is None or not previous.get(q):
+                continue
+            change = current[q] / previous[q] - 1
+            if change > tolerance:
+                regressions.append(
+                    f"{name} {q}: {previous[q]:.3f}s -> {current[q]:.3f}s "
+                    f"(+{change:.0%})"
+                )
+    if summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"throughput: {baseline['throughput']:.2f} -> "
+            f"{summary['throughput']:.2f} turns/s"
+        )
+    return regressions
+
+
+def main(args) -> int:
+    with open(args.questions, "r") as f:
+        corpus = [line.strip() for line in f if line.strip()]
+    rng = random.Random(args.seed)
+    questions = [rng.choice(corpus) for _ in range(args.turns)]
+
+    services = MockServices(
+        load_profiles(args.profile, args.throttle_rate, args.error_rate), args.seed
+    )
+    server = MockServer(services)
+    server.start()
+
+    # The pipeline logs every turn, only show it with --verbose
+    log = sys.stdout if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(log):
+        app, orchestrator, sessions = create_pipeline(
+            server.url,
+            args.turns,
+            args.answer_cache,
+            args.fused_planner,
+            args.speculative_search,
+        )
+        loop = asyncio.get_event_loop()
+        try:
+            results, duration = loop.run_until_complete(
+                run_benchmark(orchestrator, sessions, questions, args.concurrency)
+            )
+        finally:
+            loop.run_until_complete(app["search_plugin"].close())
+            server.stop()
+
+    summary = summarize(
+        results, duration, list(orchestrator.tracer.traces), services.stats_summary()
+    )
+    summary["speculative_search"] = orchestrator.speculation_stats()
+    summary["config"] = vars(args)
+    print_summary(summary)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--questions",
+        type=str,
+        default=DEFAULT_QUESTIONS,
+        help="file with one question per line",
+    )
+    parser.add_argument("--turns", type=int, default=100, help="number of turns")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="number of concurrent users"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--profile", type=str, default=None, help="JSON file of service profiles"
+    )
+    parser.add_argument(
+        "--throttle_rate", type=float, default=None, help="429 rate of all services"
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=None, help="500 rate of all services"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="JSON file to save the results to"
+    )
+    parser.add_argument(
+        "--compare", type=str, default=None, help="JSON results of a previous run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative slowdown reported as a regression by --compare",
+    )
+    parser.add_argument(
+        "--answer_cache", action="store_true", help="enable the answer cache"
+    )
+    parser.add_argument(
+        "--fused_planner",
+        action="store_true",
+        help="create the plan and the search query in one call",
+    )
+    parser.add_argument(
+        "--speculative_search",
+        action="store_true",
+        help="search for the raw question while the planner runs",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline log")
+    args = parser.parse_args()
+
+    sys.exit(main(args))
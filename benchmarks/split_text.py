@@ -0,0 +1,129 @@
+# This is a micro-benchmark of the text chunking in scripts/data_prep.py. It
+# compares split_text and split_pages with the previous character-by-character
+# implementation on the example PDFs, and checks that all produce the same
+# sections. To run it: python split_text.py --data_input_dir ../data/input
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+from data_prep import (  # noqa: E402
+    MAX_SECTION_LENGTH,
+    SECTION_OVERLAP,
+    SENTENCE_SEARCH_LIMIT,
+    get_document_text,
+    split_pages,
+    split_text,
+)
+
+
+def reference_split_text(page_map):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        num_pages = len(page_map)
+        for i in range(num_pages - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return num_pages - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            while (
+                end < length
+                and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT
+                and all_text[end] not in SENTENCE_ENDINGS
+            ):
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word  # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        while (
+            start > 0
+            and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT
+            and all_text[start] not in SENTENCE_ENDINGS
+        ):
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (
+            last_table_start > 2 * SENTENCE_SEARCH_LIMIT
+            and last_table_start > section_text.rfind("</table")
+        ):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_input_dir", type=str, help="input document directory")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs")
+    args = parser.parse_args()
+
+    file_list = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(args.data_input_dir)
+        for file in files
+        if file.endswith(".pdf")
+    )
+    page_maps = [get_document_text(file_path) for file_path in file_list]
+    characters = sum(len(p[2]) for page_map in page_maps for p in page_map)
+    print(f"Loaded {len(file_list)} files, {characters} characters")
+
+    implementations = {
+        "reference": lambda page_map: list(reference_split_text(page_map)),
+        "split_text": lambda page_map: list(split_text(page_map)),
+        "split_pages": lambda page_map: list(split_pages(p[2] for p in page_map)),
+    }
+
+    for page_map in page_maps:
+        expected = implementations["reference"](page_map)
+        for name, implementation in implementations.items():
+            assert implementation(page_map) == expected, f"{name} differs"
+
+    timings = {}
+    for name, implementation in implementations.items():
+        timings[name] = min(
+            timeit.repeat(
+                lambda: [implementation(page_map) for page_map in page_maps],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+    for name, seconds in timings.items():
+        speedup = timings["reference"] / seconds
+        print(f"{name:>12}: {seconds * 1000:8.1f} ms ({speedup:.1f}x)")
@@ -4,8 +4,24 @@
 
 import argparse
 import base64
+import hashlib
+import itertools
+import json
 import os
+import queue
+import random
 import re
+import sys
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 
 import openai
 from azure.core.credentials import AzureKeyCredential
@@ -24,20 +40,47 @@ from azure.search.documents.indexes.models import (
 from dotenv import dotenv_values
 from pypdf import PdfReader, PdfWriter
 
+# Share the embedding cache with the app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache  # noqa: E402
+from index_version import bump_index_version  # noqa: E402
+from rate_limit import (  # noqa: E402
+    RETRYABLE_STATUSES,
+    error_status,
+    get_limiter,
+    is_retryable,
+    limits_from_settings,
+)
+from tokens import count_tokens  # noqa: E402
+
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+EMBED_BATCH_SIZE = 16
+EMBED_CONCURRENCY = 4
+# Azure Cognitive Search accepts up to 1000 documents and 16 MB per request
+UPLOAD_BATCH_SIZE = 1000
+UPLOAD_BATCH_BYTES = 12 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+UPLOAD_MAX_RETRIES = 3
+UPLOAD_RETRY_DELAY = 0.5
+# Capacity of the queues between the pipeline stages, in files and in sections
+FILE_QUEUE_SIZE = 2
+SECTION_QUEUE_SIZE = 500
 
 
-def get_document_text(filename, output_dir=None):
-    offset = 0
-    page_map = []
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+SENTENCE_ENDINGS_PATTERN = re.compile("[" + re.escape("".join(SENTENCE_ENDINGS)) + "]")
+WORDS_BREAKS_PATTERN = re.compile("[" + re.escape("".join(WORDS_BREAKS)) + "]")
+
+
+def iter_document_pages(filename, output_dir=None):
+    """Yield the text of each page of a PDF file."""
     reader = PdfReader(filename)
     pages = reader.pages
     for page_num, p in enumerate(pages):
         page_text = p.extract_text()
-        page_map.append((page_num, offset, page_text))
-        offset += len(page_text)
         if output_dir:
             writer = PdfWriter()
             writer.add_page(p)
@@ -46,108 +89,363 @@ def get_document_text(filename, output_dir=None):
                 f"{os.path.basename(filename).split('.')[0]}_{page_num}.pdf",
             )
             writer.write(output_pdf_path)
+        yield page_text
+
+
+def get_document_text(filename, output_dir=None):
+    offset = 0
+    page_map = []
+    for page_num, page_text in enumerate(iter_document_pages(filename, output_dir)):
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
 
     return page_map
 
 
+def find_section(text, text_offset, start, length):
+    """
+    Find the section of the document starting around start, and return its
+    (start, end) positions. Positions are offsets in the whole document, while
+    text only holds the document from text_offset on.
+    """
+    end = start + MAX_SECTION_LENGTH
+
+    if end > length:
+        end = length
+    else:
+        # Try to find the end of the sentence
+        limit = min(length, end + SENTENCE_SEARCH_LIMIT)
+        match = SENTENCE_ENDINGS_PATTERN.search(
+            text, end - text_offset, limit - text_offset
+        )
+        sentence_end = match.start() + text_offset if match else limit
+        # Last word break before the end of the sentence
+        last_word = -1
+        for match in WORDS_BREAKS_PATTERN.finditer(
+            text, end - text_offset, sentence_end - text_offset
+        ):
+            last_word = match.start() + text_offset
+        end = sentence_end
+        if (
+            end < length
+            and text[end - text_offset] not in SENTENCE_ENDINGS
+            and last_word > 0
+        ):
+            end = last_word  # Fall back to at least keeping a whole word
+    if end < length:
+        end += 1
+
+    # Try to find the start of the sentence or at least a whole word boundary
+    last_word = -1
+    lower_bound = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+    if start > lower_bound:
+        sentence_start = max(
+            text.rfind(c, lower_bound + 1 - text_offset, start + 1 - text_offset)
+            for c in SENTENCE_ENDINGS
+        )
+        if sentence_start >= 0:
+            sentence_start += text_offset
+        else:
+            sentence_start = lower_bound
+        # First word break after the start of the sentence
+        match = WORDS_BREAKS_PATTERN.search(
+            text, sentence_start + 1 - text_offset, start + 1 - text_offset
+        )
+        if match:
+            last_word = match.start() + text_offset
+        start = sentence_start
+    if text[start - text_offset] not in SENTENCE_ENDINGS and last_word > 0:
+        start = last_word
+    if start > 0:
+        start += 1
+
+    return start, end
+
+
+def next_section_start(section_text, start, end):
+    """Return where the section after the given one starts."""
+    last_table_start = section_text.rfind("<table")
+    if (
+        last_table_start > 2 * SENTENCE_SEARCH_LIMIT
+        and last_table_start > section_text.rfind("</table")
+    ):
+        return min(end - SECTION_OVERLAP, start + last_table_start)
+    return end - SECTION_OVERLAP
+
+
 def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+    page_offsets = [p[1] for p in page_map]
 
     def find_page(offset):
-        num_pages = len(page_map)
-        for i in range(num_pages - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return num_pages - 1
+        return bisect_right(page_offsets, offset) - 1
 
     all_text = "".join(p[2] for p in page_map)
     length = len(all_text)
     start = 0
     end = length
     while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while (
-                end < length
-                and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT
-                and all_text[end] not in SENTENCE_ENDINGS
-            ):
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word  # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while (
-            start > 0
-            and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT
-            and all_text[start] not in SENTENCE_ENDINGS
-        ):
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
+        start, end = find_section(all_text, 0, start, length)
         section_text = all_text[start:end]
         yield (section_text, find_page(start))
 
-        last_table_start = section_text.rfind("<table")
-        if (
-            last_table_start > 2 * SENTENCE_SEARCH_LIMIT
-            and last_table_start > section_text.rfind("</table")
-        ):
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
+        start = next_section_start(section_text, start, end)
 
     if start + SECTION_OVERLAP < end:
         yield (all_text[start:end], find_page(start))
 
 
+def split_pages(pages):
+    """
+    Streaming version of split_text, taking the text of each page in turn.
+    Only the text around the current section is kept in memory. Yields the
+    same sections as split_text.
+    """
+    pages = iter(pages)
+    # Text needed after the start of a section to find its end
+    lookahead = MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT + 2
+    # Text needed before the start of a section to find its start
+    lookbehind = MAX_SECTION_LENGTH + 2 * SENTENCE_SEARCH_LIMIT
+    page_offsets = []
+    text = ""
+    text_offset = 0
+    length = 0
+
+    def read_until(position):
+        nonlocal text, length
+        while length < position:
+            page_text = next(pages, None)
+            if page_text is None:
+                return
+            page_offsets.append(length)
+            text += page_text
+            length += len(page_text)
+
+    def find_page(offset):
+        return bisect_right(page_offsets, offset) - 1
+
+    start = 0
+    read_until(start + lookahead)
+    end = length
+    while start + SECTION_OVERLAP < length:
+        start, end = find_section(text, text_offset, start, length)
+        section_text = text[start - text_offset : end - text_offset]
+        yield (section_text, find_page(start))
+
+        start = next_section_start(section_text, start, end)
+
+        # Drop the text that is no longer needed, once it is at least half of
+        # the buffer so that copying stays linear, and read ahead
+        keep = start - lookbehind
+        if keep - text_offset > len(text) // 2:
+            text = text[keep - text_offset :]
+            text_offset = keep
+        read_until(start + lookahead)
+
+    if start + SECTION_OVERLAP < end:
+        yield (text[start - text_offset : end - text_offset], find_page(start))
+
+
+def extract_document_chunks(file_path, output_dir=None):
+    """Extract the text of a PDF file and split it into chunks."""
+    chunks = split_pages(iter_document_pages(file_path, output_dir))
+    return file_path, list(chunks)
+
+
+def iter_document_chunks(file_paths, output_dir=None, workers=0):
+    """
+    Yield (file path, chunks) for each file. With more than one worker, files
+    are extracted in a process pool and yielded as they finish, with at most
+    two files per worker extracted ahead of the consumer.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            yield file_path, split_pages(iter_document_pages(file_path, output_dir))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending_paths = iter(file_paths)
+        futures = set()
+        while True:
+            for file_path in itertools.islice(
+                pending_paths, 2 * workers - len(futures)
+            ):
+                futures.add(
+                    executor.submit(extract_document_chunks, file_path, output_dir)
+                )
+            if not futures:
+                return
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
     filename_hash = base64.b16encode(filename.encode("utf-8")).decode("ascii")
     return f"file-{filename_ascii}-{filename_hash}"
 
 
-def create_embedding(text, openai_embedding_model):
-    try:
-        embedded_text = openai.Embedding.create(
-            input=text, deployment_id=openai_embedding_model
-        )["data"][0]["embedding"]
-    except Exception as e:
-        print(f"Error creating embedding for text: {text} with error: {e}")
-        embedded_text = None
-    return embedded_text
+def content_hash(*parts):
+    """Hash the given strings, used to detect changed files and sections."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    Load the manifest recording, per indexed file, its content hash and the
+    content hash of each of its sections by document ID.
+    """
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def embed_batch(texts, openai_embedding_model):
+    """
+    Embed a batch of texts in one request, within the rate limits of the
+    deployment shared with the other threads.
+    """
+    response = get_limiter(openai_embedding_model).call(
+        lambda: openai.Embedding.create(
+            input=texts, deployment_id=openai_embedding_model
+        ),
+        tokens=sum(count_tokens(text) for text in texts),
+        usage=lambda r: r.get("usage", {}).get("prompt_tokens"),
+    )
+    data = sorted(response["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in data]
+
+
+def create_embeddings(
+    texts,
+    openai_embedding_model,
+    embedding_cache=None,
+    batch_size=EMBED_BATCH_SIZE,
+    concurrency=EMBED_CONCURRENCY,
+):
+    """
+    Create embeddings for a list of texts, sending batches of texts
+    concurrently. Returns None for texts whose embedding could not be created.
+    """
+    embeddings = [None] * len(texts)
+    missing = []
+    for i, text in enumerate(texts):
+        if embedding_cache is not None:
+            embeddings[i] = embedding_cache.get(openai_embedding_model, text)
+        if embeddings[i] is None:
+            missing.append(i)
+
+    def embed(indexes):
+        batch = [texts[i] for i in indexes]
+        try:
+            return indexes, embed_batch(batch, openai_embedding_model)
+        except Exception as e:
+            if len(indexes) == 1:
+                print(f"Error creating embedding for text: {batch[0]} with error: {e}")
+                return indexes, [None]
+            # Retry the items of a failed batch one by one
+            return indexes, [embed([i])[1][0] for i in indexes]
+
+    batches = [missing[i : i + batch_size] for i in range(0, len(missing), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for indexes, results in executor.map(embed, batches):
+            for i, embedding in zip(indexes, results):
+                embeddings[i] = embedding
+                if embedding is not None and embedding_cache is not None:
+                    embedding_cache.set(openai_embedding_model, texts[i], embedding)
+
+    return embeddings
+
+
+def create_embedding(text, openai_embedding_model, embedding_cache=None):
+    return create_embeddings([text], openai_embedding_model, embedding_cache)[0]
 
 
-def create_sections(filename, page_map, output_dir, openai_embedding_model=None):
+def create_sections(
+    filename,
+    chunks,
+    output_dir,
+    openai_embedding_model=None,
+    embedding_cache=None,
+    batch_size=EMBED_BATCH_SIZE,
+    concurrency=EMBED_CONCURRENCY,
+    previous_hashes=None,
+    section_hashes=None,
+    failures=None,
+):
+    """
+    Create sections from the (content, page number) chunks of a document and
+    embed them. The hash of every section is recorded in section_hashes, and
+    sections whose hash matches previous_hashes are skipped as they are
+    already indexed. Sections whose embedding failed are recorded in failures.
+    """
     file_id = filename_to_id(filename)
-    for i, (content, page_num) in enumerate(split_text(page_map)):
-        section = {
-            "id": f"{file_id}-page-{i}",
-            "content": content,
-            "content_vector": create_embedding(content, openai_embedding_model),
-            "category": args.category,
-            "source_page": os.path.join(
-                output_dir, f"{filename.split('.')[0]}_{str(page_num)}.pdf"
-            ),
-            "source_file": filename,
-        }
-        yield section
+    previous_hashes = previous_hashes or {}
+    section_hashes = {} if section_hashes is None else section_hashes
+    failures = {} if failures is None else failures
+
+    def changed_chunks():
+        for i, (content, page_num) in enumerate(chunks):
+            section_id = f"{file_id}-page-{i}"
+            section_hash = content_hash(
+                content, str(page_num), args.category or "", filename
+            )
+            section_hashes[section_id] = section_hash
+            if previous_hashes.get(section_id) != section_hash:
+                yield i, (content, page_num)
+
+    # Embed enough chunks at a time to keep every worker busy
+    group_size = batch_size * concurrency
+    pending = changed_chunks()
+    while True:
+        group = list(itertools.islice(pending, group_size))
+        if not group:
+            break
+        embeddings = create_embeddings(
+            [content for _, (content, _) in group],
+            openai_embedding_model,
+            embedding_cache,
+            batch_size,
+            concurrency,
+        )
+        for (i, (content, page_num)), content_vector in zip(group, embeddings):
+            section_id = f"{file_id}-page-{i}"
+            if content_vector is None:
+                # Do not index sections without a vector
+                print(f"\tSkipping section {section_id}: embedding failed")
+                failures[section_id] = "embedding failed"
+                continue
+            section = {
+                "id": section_id,
+                "content": content,
+                "content_vector": content_vector,
+                "category": args.category,
+                "source_page": os.path.join(
+                    output_dir, f"{filename.split('.')[0]}_{str(page_num)}.pdf"
+                ),
+                "source_file": filename,
+            }
+            yield section
 
 
 def create_search_index(index_client, index_name):
@@ -191,23 +489,356 @@ def create_search_index(index_client, index_name):
         print(f"Search index {index_name} already exists")
 
 
-def index_sections(search_client, filename, sections):
-    print(f"Indexing sections from '{filename}' into search index '{index_name}'")
-    i = 0
+def iter_upload_batches(sections, max_documents, max_bytes):
+    """
+    Group sections into upload batches of at most max_documents sections and
+    max_bytes of serialized JSON.
+    """
     batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    batch_bytes = 0
+    for section in sections:
+        section_bytes = len(json.dumps(section)) + 1
+        if batch and (
+            len(batch) >= max_documents or batch_bytes + section_bytes > max_bytes
+        ):
+            yield batch
             batch = []
+            batch_bytes = 0
+        batch.append(section)
+        batch_bytes += section_bytes
+    if batch:
+        yield batch
+
+
+def upload_batch(search_client, batch, max_retries=UPLOAD_MAX_RETRIES):
+    """
+    Upload a batch of sections, retrying the sections that failed with a
+    transient error, and the whole batch if the request failed. A batch too
+    large for the service is split in two. Returns the IDs of the sections
+    that succeeded and the errors of those that did not, by ID.
+    """
+    succeeded_ids = []
+    failures = {}
+    pending = batch
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            time.sleep(random.uniform(0, UPLOAD_RETRY_DELAY * 2**attempt))
+        try:
+            results = search_client.upload_documents(documents=pending)
+        except Exception as e:
+            if error_status(e) == 413 and len(pending) > 1:
+                # The parts report the errors of the pending sections, drop
+                # those of the earlier attempts
+                for section in pending:
+                    failures.pop(section["id"], None)
+                half = len(pending) // 2
+                for part in (pending[:half], pending[half:]):
+                    part_succeeded, part_failures = upload_batch(
+                        search_client, part, max_retries
+                    )
+                    succeeded_ids.extend(part_succeeded)
+                    failures.update(part_failures)
+                return succeeded_ids, failures
+            for section in pending:
+                failures[section["id"]] = str(e)
+            if not is_retryable(e):
+                break
+            continue
+
+        retry_ids = set()
+        for r in results:
+            if r.succeeded:
+                succeeded_ids.append(r.key)
+                failures.pop(r.key, None)
+                continue
+            status_code = getattr(r, "status_code", None)
+            failures[r.key] = getattr(r, "error_message", None) or f"{status_code}"
+            if status_code in RETRYABLE_STATUSES:
+                retry_ids.add(r.key)
+        pending = [section for section in pending if section["id"] in retry_ids]
+        if not pending:
+            break
+    return succeeded_ids, failures
+
+
+def index_sections(
+    search_client,
+    filename,
+    sections,
+    on_batch=None,
+    concurrency=UPLOAD_CONCURRENCY,
+    failures=None,
+):
+    """
+    Upload the sections in batches, with several batches in flight, and
+    return the IDs of those that succeeded. on_batch is called with the IDs
+    that succeeded in each uploaded batch, and the errors of the sections
+    that still failed after retries are recorded in failures.
+    """
+    print(f"Indexing sections from '{filename}' into search index '{index_name}'")
+    succeeded_ids = []
+    failures = {} if failures is None else failures
+    file_failures = {}
+
+    def finish(future):
+        batch_succeeded, batch_failures = future.result()
+        succeeded_ids.extend(batch_succeeded)
+        file_failures.update(batch_failures)
+        print(
+            f"\tIndexed {len(batch_succeeded) + len(batch_failures)} sections, "
+            f"{len(batch_succeeded)} succeeded"
+        )
+        if on_batch is not None:
+            on_batch(batch_succeeded)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = set()
+        for batch in iter_upload_batches(
+            sections, UPLOAD_BATCH_SIZE, UPLOAD_BATCH_BYTES
+        ):
+            if len(futures) >= concurrency:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            futures.add(executor.submit(upload_batch, search_client, batch))
+        for future in as_completed(futures):
+            finish(future)
+
+    for section_id, error in sorted(file_failures.items()):
+        print(f"\tFailed to index section {section_id}: {error}")
+    failures.update(file_failures)
+    return succeeded_ids
+
+
+def delete_sections(search_client, filename, section_ids):
+    """Delete sections that no longer exist from the search index."""
+    if not section_ids:
+        return
+    print(f"Deleting {len(section_ids)} stale sections of '{filename}'")
+    search_client.delete_documents(documents=[{"id": i} for i in section_ids])
+
+
+class PipelineStopped(Exception):
+    """Raised in a pipeline stage when another stage failed."""
+
+
+class Stage(threading.Thread):
+    """
+    A stage of the indexing pipeline, running in its own thread and connected
+    to its neighbours by bounded queues. It counts the items it handled and
+    the time it waited on its queues, to report its throughput.
+    """
+
+    def __init__(self, name, unit, func, stop):
+        super().__init__(name=name, daemon=True)
+        self.unit = unit
+        self.func = func
+        self.stop = stop
+        self.items = 0
+        self.waiting = 0.0
+        self.elapsed = 0.0
+        self.error = None
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.func(self)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+    def put(self, items, item):
+        """Put an item in a queue, waiting while it is full."""
+        start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise PipelineStopped()
+        finally:
+            self.waiting += time.perf_counter() - start
+
+    def get(self, items):
+        """Get an item from a queue, waiting while it is empty."""
+        start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    return items.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise PipelineStopped()
+        finally:
+            self.waiting += time.perf_counter() - start
+
+    def report(self):
+        busy = self.elapsed - self.waiting
+        rate = self.items / busy if busy > 0 else 0.0
+        waited = self.waiting / self.elapsed if self.elapsed > 0 else 0.0
+        return (
+            f"{self.name}: {self.items} {self.unit} in {self.elapsed:.1f}s, "
+            f"{rate:.1f} {self.unit}/s when busy, waited {waited:.0%} of the time"
+        )
+
+
+def run_indexing_pipeline(
+    changed_files,
+    manifest,
+    manifest_path,
+    checkpoint,
+    checkpoint_path,
+    search_client,
+    openai_embedding_model,
+    embedding_cache,
+    failures,
+):
+    """
+    Extract, embed and upload the changed files in three concurrent stages.
+    The checkpoint records the sections of each upload batch once it is
+    confirmed, and the manifest each file once it is done. Sections already
+    recorded in the checkpoint of the same file content are skipped. The
+    sections that failed to embed or upload are recorded in failures. Returns
+    whether the index changed.
+    """
+    stop = threading.Event()
+    file_queue = queue.Queue(FILE_QUEUE_SIZE)
+    section_queue = queue.Queue(SECTION_QUEUE_SIZE)
+    end_of_file = object()
+    index_changed = False
+
+    # Sections uploaded by an interrupted run, by file
+    resumed = {
+        file_name: dict(entry["sections"])
+        for file_name, entry in checkpoint["files"].items()
+    }
+
+    def extract(stage):
+        for file_path, chunks in iter_document_chunks(
+            list(changed_files), args.data_output_dir, args.workers
+        ):
+            chunks = list(chunks)
+            stage.items += 1
+            stage.put(file_queue, (file_path, chunks))
+        stage.put(file_queue, None)
+
+    def embed(stage):
+        while True:
+            item = stage.get(file_queue)
+            if item is None:
+                break
+            file_path, chunks = item
+            file_name = os.path.basename(file_path)
+            previous, current_file_hash = changed_files[file_path]
+            indexed_hashes = dict(previous["sections"])
+            entry = checkpoint["files"].get(file_name)
+            if entry is not None and entry["hash"] == current_file_hash:
+                indexed_hashes.update(resumed.get(file_name, {}))
+
+            # create chunks and embed the changed ones
+            section_hashes = {}
+            stage.put(section_queue, (file_path, section_hashes, indexed_hashes))
+            for section in create_sections(
+                file_name,
+                chunks,
+                args.data_output_dir,
+                openai_embedding_model,
+                embedding_cache,
+                args.embed_batch_size,
+                args.embed_concurrency,
+                indexed_hashes,
+                section_hashes,
+                failures,
+            ):
+                stage.items += 1
+                stage.put(section_queue, section)
+            stage.put(section_queue, end_of_file)
+        stage.put(section_queue, None)
+
+    def upload(stage):
+        nonlocal index_changed
+        while True:
+            item = stage.get(section_queue)
+            if item is None:
+                break
+            file_path, section_hashes, indexed_hashes = item
+            file_name = os.path.basename(file_path)
+            previous, current_file_hash = changed_files[file_path]
+            entry = checkpoint["files"].get(file_name)
+            if entry is None or entry["hash"] != current_file_hash:
+                entry = {"hash": current_file_hash, "sections": {}}
+                checkpoint["files"][file_name] = entry
+
+            def sections():
+                while True:
+                    section = stage.get(section_queue)
+                    if section is end_of_file:
+                        return
+                    yield section
+
+            def on_batch(succeeded_ids):
+                stage.items += len(succeeded_ids)
+                if args.search_backend == "local":
+                    # The local index only keeps the uploads once it is saved
+                    return
+                for section_id in succeeded_ids:
+                    entry["sections"][section_id] = section_hashes[section_id]
+                save_manifest(checkpoint, checkpoint_path)
+
+            succeeded_ids = set(
+                index_sections(
+                    search_client,
+                    file_name,
+                    sections(),
+                    on_batch,
+                    # The local index is not safe to update from threads
+                    1 if args.search_backend == "local" else args.upload_concurrency,
+                    failures,
+                )
+            )
+
+            # remove sections that no longer exist
+            stale_ids = sorted(set(previous["sections"]) - set(section_hashes))
+            delete_sections(search_client, file_name, stale_ids)
+            index_changed = index_changed or bool(succeeded_ids or stale_ids)
 
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+            # only record sections that are in the index, so failures are retried
+            indexed = {
+                section_id: section_hash
+                for section_id, section_hash in section_hashes.items()
+                if section_id in succeeded_ids
+                or indexed_hashes.get(section_id) == section_hash
+            }
+            complete = len(indexed) == len(section_hashes)
+            manifest["files"][file_name] = {
+                "hash": current_file_hash if complete else None,
+                "sections": indexed,
+            }
+            if args.search_backend == "local":
+                search_client.save()
+            save_manifest(manifest, manifest_path)
+
+    stages = [
+        Stage("extract", "files", extract, stop),
+        Stage("embed", "sections", embed, stop),
+        Stage("upload", "sections", upload, stop),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    for stage in stages:
+        print(stage.report())
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    return index_changed
 
 
 # Usage: python data_prep.py --data_input_dir ../data/input --data_output_dir ../data/output --category "handbook" # noqa
@@ -216,6 +847,66 @@ if __name__ == "__main__":
     parser.add_argument("--data_input_dir", type=str, help="input document directory")
     parser.add_argument("--data_output_dir", type=str, help="output chunk directory")
     parser.add_argument("--category", type=str, help="category of the document")
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default=DEFAULT_CACHE_PATH,
+        help="embedding cache file",
+    )
+    parser.add_argument(
+        "--embed_batch_size",
+        type=int,
+        default=EMBED_BATCH_SIZE,
+        help="number of texts per embedding request",
+    )
+    parser.add_argument(
+        "--embed_concurrency",
+        type=int,
+        default=EMBED_CONCURRENCY,
+        help="number of embedding requests in flight",
+    )
+    parser.add_argument(
+        "--upload_concurrency",
+        type=int,
+        default=UPLOAD_CONCURRENCY,
+        help="number of upload batches in flight",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="index manifest file, defaults to index_manifest.json in the "
+        "output directory, or in the local index directory",
+    )
+    parser.add_argument(
+        "--full_reindex",
+        action="store_true",
+        help="ignore the manifest and re-index every file",
+    )
+    parser.add_argument(
+        "--search_backend",
+        type=str,
+        choices=["azure", "local"],
+        default="azure",
+        help="index into Azure Cognitive Search or a local index",
+    )
+    parser.add_argument(
+        "--local_index_dir",
+        type=str,
+        default="../data/local_index",
+        help="directory of the local index",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the sections uploaded by an interrupted run",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of processes extracting and chunking PDF files",
+    )
     args = parser.parse_args()
 
     # check if output directory exists
@@ -226,18 +917,25 @@ if __name__ == "__main__":
     config = dotenv_values("../.env")
 
     # Azure search service to use
-    search_service = config["AZURE_SEARCH_SERVICE"]
-    index_name = config["AZURE_SEARCH_INDEX"]
-    search_cred = AzureKeyCredential(config["AZURE_SEARCH_KEY"])
-    index_client = SearchIndexClient(
-        endpoint=f"https://{config['AZURE_SEARCH_SERVICE']}.search.windows.net/",
-        credential=search_cred,
-    )
-    search_client = SearchClient(
-        endpoint=f"https://{search_service}.search.windows.net/",
-        index_name=index_name,
-        credential=search_cred,
-    )
+    if args.search_backend == "local":
+        # Local in-process index, with the same upload and delete calls
+        from local_index import LocalSearchIndex
+
+        index_name = args.local_index_dir
+        search_client = LocalSearchIndex(index_name)
+    else:
+        search_service = config["AZURE_SEARCH_SERVICE"]
+        index_name = config["AZURE_SEARCH_INDEX"]
+        search_cred = AzureKeyCredential(config["AZURE_SEARCH_KEY"])
+        index_client = SearchIndexClient(
+            endpoint=f"https://{config['AZURE_SEARCH_SERVICE']}.search.windows.net/",
+            credential=search_cred,
+        )
+        search_client = SearchClient(
+            endpoint=f"https://{search_service}.search.windows.net/",
+            index_name=index_name,
+            credential=search_cred,
+        )
 
     # OpenAI for embedding
     openai.api_base = config["AZURE_OPENAI_ENDPOINT"]
@@ -245,6 +943,11 @@ if __name__ == "__main__":
     openai.api_type = "azure"
     openai.api_key = config["AZURE_OPENAI_API_KEY"]
     openai_embedding_model = config["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
+    get_limiter(
+        openai_embedding_model,
+        **limits_from_settings(config, "AZURE_OPENAI_EMBEDDING"),
+    )
+    embedding_cache = EmbeddingCache(args.embedding_cache)
 
     # select pdf files to process
     file_list = [
@@ -255,16 +958,80 @@ if __name__ == "__main__":
     ]
 
     # create Azure Cognitive Search index
-    create_search_index(index_client, index_name)
+    if args.search_backend == "azure":
+        create_search_index(index_client, index_name)
+
+    # load the manifest of previously indexed files
+    manifest_dir = args.data_output_dir
+    if args.search_backend == "local":
+        manifest_dir = args.local_index_dir
+    manifest_path = args.manifest or os.path.join(manifest_dir, "index_manifest.json")
+    manifest = {"files": {}} if args.full_reindex else load_manifest(manifest_path)
+
+    # progress of an interrupted run, removed when a run completes
+    checkpoint_path = manifest_path + ".checkpoint"
+    checkpoint = {"files": {}}
+    if os.path.exists(checkpoint_path):
+        if args.resume:
+            print(f"Resuming from checkpoint '{checkpoint_path}'")
+            checkpoint = load_manifest(checkpoint_path)
+        else:
+            print(
+                f"Ignoring the checkpoint '{checkpoint_path}' of an interrupted "
+                "run, use --resume to continue it"
+            )
 
     print("Start indexing files...")
+    changed_files = {}
     for file_path in file_list:
-        # extract text from pdf
-        page_map = get_document_text(file_path, args.data_output_dir)
-
-        # create chunks and index them
         file_name = os.path.basename(file_path)
-        sections = create_sections(
-            file_name, page_map, args.data_output_dir, openai_embedding_model
+        previous = manifest["files"].get(file_name, {"hash": None, "sections": {}})
+        current_file_hash = file_hash(file_path)
+        if current_file_hash == previous["hash"]:
+            print(f"Skipping unchanged file '{file_name}'")
+            continue
+        changed_files[file_path] = (previous, current_file_hash)
+
+    # extract, embed and upload the changed files concurrently
+    failures = {}
+    index_changed = run_indexing_pipeline(
+        changed_files,
+        manifest,
+        manifest_path,
+        checkpoint,
+        checkpoint_path,
+        search_client,
+        openai_embedding_model,
+        embedding_cache,
+        failures,
+    )
+
+    # remove files that no longer exist
+    current_files = {os.path.basename(file_path) for file_path in file_list}
+    for file_name in sorted(set(manifest["files"]) - current_files):
+        delete_sections(
+            search_client, file_name, sorted(manifest["files"][file_name]["sections"])
         )
-        index_sections(search_client, file_name, sections)
+        del manifest["files"][file_name]
+        save_manifest(manifest, manifest_path)
+        index_changed = True
+
+    if args.search_backend == "local":
+        search_client.save()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # let the app know that cached search results are stale
+    if index_changed:
+        print(f"Index version: {bump_index_version(index_name)}")
+
+    # report the sections that could not be indexed, retried by the next run
+    if failures:
+        print(f"{len(failures)} sections failed to index:")
+        for section_id, error in sorted(failures.items()):
+            print(f"\t{section_id}: {error}")
+    else:
+        print("All sections indexed")
+
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    embedding_cache.close()
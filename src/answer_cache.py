@@ -0,0 +1,169 @@
+# This file contains the semantic answer cache. It stores the answers of past
+# questions with their embeddings, so that a paraphrase of a question that was
+# answered before can be answered without calling the planner, the search and
+# the chat model.
+
+import time
+from collections import OrderedDict
+
+
+class AnswerEntry:
+    __slots__ = ("answer", "vector", "expires_at")
+
+    def __init__(self, answer: str, vector, expires_at: float):
+        self.answer = answer
+        self.vector = vector
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers keyed by question and chat history context. A question
+    matches an entry of the same context if it is the same question, or if
+    the cosine similarity of their embeddings is at least the threshold.
+    Entries are dropped when the version of the search index changes.
+    """
+
+    def __init__(
+        self,
+        embed,
+        threshold: float = 0.95,
+        maxsize: int = 1024,
+        ttl: float = 86400,
+        context_turns: int = 1,
+        index_version=None,
+    ):
+        # Async function returning the embedding of a text, or None
+        self.embed = embed
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Number of previous user messages an answer depends on
+        self.context_turns = context_turns
+        self._index_version = index_version
+        self._cached_index_version = None
+        # Entries keyed by (normalized question, context), least recent first
+        self._entries = OrderedDict()
+        # Normalized embeddings of the entries, rebuilt after a change
+        self._matrix = None
+        self._matrix_keys = []
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_index_version(self):
+        if self._index_version is None:
+            return
+        index_version = self._index_version.current()
+        if index_version != self._cached_index_version:
+            self.clear()
+            self._cached_index_version = index_version
+
+    @staticmethod
+    def _normalize(vector):
+        import numpy as np
+
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _similar_entries(self, vector) -> list:
+        """
+        Return the keys of the entries whose similarity with a normalized
+        vector is at least the threshold, most similar first.
+        """
+        import numpy as np
+
+        if self._matrix is None:
+            self._matrix_keys = [
+                key for key, entry in self._entries.items() if entry.vector is not None
+            ]
+            if not self._matrix_keys:
+                return []
+            self._matrix = np.stack(
+                [self._entries[key].vector for key in self._matrix_keys]
+            )
+        similarities = self._matrix @ vector
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        candidates = sorted(candidates.tolist(), key=lambda i: -similarities[i])
+        return [self._matrix_keys[i] for i in candidates]
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._matrix = None
+
+    async def lookup(self, question: str, context: tuple, text: str) -> tuple:
+        """
+        Return the cached answer of a question in a chat history context, or
+        None, and the embedding of the text of the question, to store with
+        its answer. The embedding is None if it was not needed.
+        """
+        self._check_index_version()
+        entry = self._get((question, context))
+        if entry is not None:
+            self.hits += 1
+            self.exact_hits += 1
+            return entry.answer, None
+
+        vector = await self.embed(text)
+        if vector is None:
+            self.misses += 1
+            return None, None
+        vector = self._normalize(vector)
+        for key in self._similar_entries(vector):
+            if key[1] != context or key not in self._entries:
+                continue
+            entry = self._get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry.answer, vector
+        self.misses += 1
+        return None, vector
+
+    def store(self, question: str, context: tuple, answer: str, vector=None):
+        """
+        Store the answer of a question, evicting the least recently used entry
+        when full.
+        """
+        self._check_index_version()
+        if vector is not None:
+            vector = self._normalize(vector)
+        self._entries[(question, context)] = AnswerEntry(
+            answer, vector, time.monotonic() + self.ttl
+        )
+        self._entries.move_to_end((question, context))
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def clear(self):
+        self._entries.clear()
+        self._matrix = None
+
+    def stats(self) -> dict:
+        """
+        Return the size and hit/miss counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "exact_hits": self.exact_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "threshold": self.threshold,
+            "index_version": self._cached_index_version,
+        }
@@ -0,0 +1,143 @@
+# This file sets up the semantic kernel and plugins shared by the console app
+# (chat.py) and the server (server.py).
+
+import os
+
+import semantic_kernel as sk
+import semantic_kernel.connectors.ai.open_ai as sk_oai
+
+import prompt_bundle
+import rate_limit
+import tokens
+import utils
+from answer_cache import SemanticAnswerCache
+from chat_service import RateLimitedChatCompletion
+from history import ChatHistoryCompactor
+from index_version import IndexVersion
+from plugins.orchestrator import Orchestrator
+from router import KeywordRouter
+from settings import is_enabled, load_settings
+from tracing import Tracer
+
+PLUGIN_PARENT_DIRECTORY = "plugins"
+
+# Chat semantic functions to load, by plugin directory
+SEMANTIC_PLUGINS = {
+    "knowledge_base_search": ["create_search_query", "create_answer", "safety_share"],
+    "planning": ["planner", "plan_and_query"],
+}
+
+
+def create_app(config: dict = None, chat_service=None) -> dict:
+    """
+    Creates a semantic kernel with the chat service and all plugins registered.
+    The settings are read from the .env file unless a config is given, and a
+    chat service can be given instead of the Azure OpenAI one, e.g. for
+    benchmarks.
+    """
+    config = config if config is not None else load_settings()
+
+    # Create a semantic kernel
+    kernel = sk.Kernel()
+
+    # Add a chat service
+    if chat_service is None:
+        oai_service = utils.azure_openai_chatgpt_settings_from_dot_env(config)
+        chat_service = sk_oai.AzureChatCompletion(
+            oai_service["deployment"], oai_service["endpoint"], oai_service["api_key"]
+        )
+    # Share the quota of the chat deployment with the other callers
+    limiter = rate_limit.get_limiter(
+        config.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chatgpt",
+        **rate_limit.limits_from_settings(config, "AZURE_OPENAI_CHATGPT"),
+    )
+    kernel.add_chat_service(
+        "chatgpt", RateLimitedChatCompletion(chat_service, limiter)
+    )
+
+    # Load the prompt and config files in one read, if a bundle was built
+    bundle_path = config.get("PROMPT_BUNDLE_PATH")
+    if bundle_path and os.path.exists(bundle_path):
+        prompt_bundle.load_prompt_bundle(bundle_path)
+
+    # Register semantic functions from plugins
+    semantic_functions = {}
+    for plugin_dir, semantic_function_list in SEMANTIC_PLUGINS.items():
+        functions = utils.import_chat_semantic_plugin_from_directory(
+            kernel,
+            PLUGIN_PARENT_DIRECTORY,
+            plugin_dir,
+            semantic_function_list,
+            "system_skprompt.txt",
+            "user_skprompt.txt",
+            "config.json",
+        )
+        semantic_functions.update(functions)
+
+    # Register the search plugin, Azure Cognitive Search unless the local
+    # index is configured. Both are registered as acs_plugin for the planner.
+    if config.get("SEARCH_BACKEND", "azure") == "local":
+        from plugins.local_search import LocalSearch
+
+        search_plugin = LocalSearch(config=config)
+    else:
+        from plugins.cognitive_search import AzureCognitiveSearch
+
+        search_plugin = AzureCognitiveSearch(config=config)
+    kernel.import_skill(
+        search_plugin,
+        "acs_plugin",
+    )
+
+    # Answer paraphrases of past questions from a cache, if enabled
+    answer_cache = None
+    if is_enabled(config, "ANSWER_CACHE"):
+        answer_cache = SemanticAnswerCache(
+            search_plugin.embed_query,
+            threshold=float(config.get("ANSWER_CACHE_THRESHOLD") or 0.95),
+            index_version=IndexVersion(search_plugin.index_name),
+        )
+
+    # Register Orchestrator plugin
+    function_configs = {
+        f"{plugin_dir}.{function_name}": semantic_functions[function_name][
+            "function_config"
+        ]
+        for plugin_dir, semantic_function_list in SEMANTIC_PLUGINS.items()
+        for function_name in semantic_function_list
+    }
+    orchestrator = Orchestrator(
+        kernel,
+        semantic_functions["create_answer"]["function_config"],
+        router=KeywordRouter(),
+        history_compactor=ChatHistoryCompactor(),
+        function_configs=function_configs,
+        # Append every trace as a JSON line to TRACE_PATH, if set
+        tracer=Tracer(trace_path=config.get("TRACE_PATH") or None),
+        answer_cache=answer_cache,
+        fused_planner=is_enabled(config, "FUSED_PLANNER"),
+        speculative_search=is_enabled(config, "SPECULATIVE_SEARCH"),
+    )
+    orchestrator_plugin = kernel.import_skill(
+        orchestrator,
+        "orchestrator_plugin",
+    )
+
+    result = {
+        "kernel": kernel,
+        "semantic_functions": semantic_functions,
+        "search_plugin": search_plugin,
+        "orchestrator": orchestrator,
+        "orchestrator_plugin": orchestrator_plugin,
+    }
+
+    return result
+
+
+async def warm_up(search_plugin) -> None:
+    """
+    Prepare the app for the first user turn: load the tokenizer and open the
+    connection to the search service.
+    """
+    tokens.get_encoding()
+    await search_plugin.warm_up()
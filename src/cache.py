@@ -0,0 +1,145 @@
+# This file contains in-memory caches shared by the plugins.
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A least-recently-used cache whose entries expire after a time-to-live.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for a key and count the hit or miss.
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        """
+        Store a value, evicting the least recently used entry when full.
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the size and hit/miss counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call, e.g. the same
+    query sent by several sessions at once, before its result is cached. All
+    callers get the result or the error of the call. A cancelled caller does
+    not cancel the call for the others, the call is only cancelled when all of
+    its callers are.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    def _done(self, key, task: asyncio.Task):
+        flight = self._flights.get(key)
+        if flight is not None and flight.task is task:
+            del self._flights[key]
+
+    async def do(self, key, func) -> tuple:
+        """
+        Return the result of the async function func, called with no arguments
+        unless a call with the same key is in flight, and whether the result
+        was coalesced with that call.
+        """
+        flight = self._flights.get(key)
+        coalesced = flight is not None
+        if coalesced:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            flight = self._flights[key] = _Flight(task)
+            task.add_done_callback(lambda task: self._done(key, task))
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                # New callers start a new call instead of joining this one
+                self._done(key, flight.task)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+        return result, coalesced
+
+    def stats(self) -> dict:
+        """Return the number of calls made and of calls coalesced with them."""
+        requests = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+            "coalesced_rate": self.coalesced / requests if requests else 0.0,
+        }
@@ -3,70 +3,21 @@
 # directory. To run the app, simply run: python chat.py
 
 import asyncio
+import time
 
-import semantic_kernel as sk
-import semantic_kernel.connectors.ai.open_ai as sk_oai
-
-import utils
-from plugins.orchestrator import Orchestrator
-from plugins.cognitive_search import AzureCognitiveSearch
-
-# Create a semantic kernel
-kernel = sk.Kernel()
-
-# Add a chat service
-oai_service = utils.azure_openai_chatgpt_settings_from_dot_env()
-kernel.add_chat_service(
-    "chatgpt",
-    sk_oai.AzureChatCompletion(
-        oai_service["deployment"], oai_service["endpoint"], oai_service["api_key"]
-    ),
-)
-
-# Register semantic functions from plugins
-plugin_parent_directory = "plugins"
-semantic_functions = {}
-
-# Load knowledge base search semantic functions
-plugin_dir = "knowledge_base_search"
-semantic_function_list = ["create_search_query", "create_answer", "safety_share"]
-functions = utils.import_chat_semantic_plugin_from_directory(
-    kernel,
-    plugin_parent_directory,
-    plugin_dir,
-    semantic_function_list,
-    "system_skprompt.txt",
-    "user_skprompt.txt",
-    "config.json",
-)
-semantic_functions.update(functions)
-
-# Load planning semantic functions
-plugin_dir = "planning"
-semantic_function_list = ["planner"]
-functions = utils.import_chat_semantic_plugin_from_directory(
-    kernel,
-    plugin_parent_directory,
-    plugin_dir,
-    semantic_function_list,
-    "system_skprompt.txt",
-    "user_skprompt.txt",
-    "config.json",
-)
-semantic_functions.update(functions)
-
-
-# Register Azure Cognitive Search plugin
-acs_plugin = kernel.import_skill(
-    AzureCognitiveSearch(),
-    "acs_plugin",
-)
-
-# Register Orchestrator plugin
-orchestrator_plugin = kernel.import_skill(
-    Orchestrator(kernel, semantic_functions["create_answer"]["function_config"]),
-    "orchestrator_plugin",
-)
+START_TIME = time.perf_counter()
+
+from app import create_app, warm_up  # noqa: E402
+from settings import is_enabled, load_settings  # noqa: E402
+
+# Print the answer token by token as it is generated
+STREAM_RESPONSE = True
+
+# Create a semantic kernel with the chat service and plugins
+app = create_app()
+search_plugin = app["search_plugin"]
+orchestrator = app["orchestrator"]
+orchestrator_plugin = app["orchestrator_plugin"]
 
 
 async def chat() -> bool:
@@ -84,19 +35,66 @@ async def chat() -> bool:
         print("\n\nExiting chat...")
         return False
 
-    # Pass user input to the orchestrator to process
-    result = await orchestrator_plugin["process_request"].invoke_async(user_input)
+    print("-" * 50)
+    if STREAM_RESPONSE:
+        await chat_stream(user_input)
+    else:
+        # Pass user input to the orchestrator to process
+        result = await orchestrator_plugin["process_request"].invoke_async(
+            user_input
+        )
 
-    # Present the response to the user
-    print(f"[Copilot]:> {result}\n")
+        # Present the response to the user
+        print(f"[Copilot]:> {result}\n")
+
+    # The orchestrator traces each request, show where the time went
+    print(f"  |Backend: Trace|: {orchestrator.tracer.traces[-1].summary()}")
+    print("-" * 50)
 
     return True
 
 
+async def chat_stream(user_input: str) -> None:
+    start_time = time.perf_counter()
+    first_token_time = None
+
+    def print_token(token: str) -> None:
+        nonlocal first_token_time
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+            print("[Copilot]:> ", end="")
+        print(token, end="", flush=True)
+
+    # Pass user input to the orchestrator and present the response as it is
+    # generated
+    result = await orchestrator.process_request_stream_async(user_input, print_token)
+    total_time = time.perf_counter() - start_time
+
+    if first_token_time is None:
+        # Nothing was streamed, e.g. no plan was found
+        first_token_time = time.perf_counter()
+        print(f"[Copilot]:> {result}")
+    else:
+        # End the line of the streamed answer
+        print()
+    print(
+        f"  |Backend: Latency|: first token {first_token_time - start_time:.2f}s, "
+        f"total {total_time:.2f}s\n"
+    )
+
+
 async def main() -> None:
+    if is_enabled(load_settings(), "WARM_UP"):
+        await warm_up(search_plugin)
+    print(f"  |Backend: Startup|: ready in {time.perf_counter() - START_TIME:.2f}s\n")
+
     chatting = True
-    while chatting:
-        chatting = await chat()
+    try:
+        while chatting:
+            chatting = await chat()
+    finally:
+        # Release the pooled search connections
+        await search_plugin.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+# This file contains the chat service registered in the kernel. It sends the
+# chat completions of another chat service, e.g. Azure OpenAI, through the
+# rate limiter shared by all calls to its deployment.
+
+import asyncio
+import itertools
+
+from semantic_kernel.connectors.ai.chat_completion_client_base import (
+    ChatCompletionClientBase,
+)
+
+from rate_limit import RateLimiter
+from tokens import estimate_tokens
+
+
+class RateLimitedChatCompletion(ChatCompletionClientBase):
+    def __init__(self, service: ChatCompletionClientBase, limiter: RateLimiter):
+        self._service = service
+        self._limiter = limiter
+
+    @staticmethod
+    def _estimate_tokens(messages: list, settings) -> int:
+        """
+        Estimate the prompt and completion tokens of a request from the length
+        of its messages, as the whole chat history is sent with every request.
+        """
+        prompt_tokens = sum(
+            estimate_tokens(m["content"] if isinstance(m, dict) else m[1])
+            for m in messages
+        )
+        return prompt_tokens + (getattr(settings, "max_tokens", None) or 0)
+
+    async def complete_chat_async(self, messages, settings):
+        return await self._limiter.call_async(
+            lambda: self._service.complete_chat_async(messages, settings),
+            tokens=self._estimate_tokens(messages, settings),
+        )
+
+    async def complete_chat_stream_async(self, messages, settings):
+        """
+        Stream a chat completion. A request is only retried if it failed before
+        its first chunk, so that no chunk is streamed twice.
+        """
+        tokens = self._estimate_tokens(messages, settings)
+        for attempt in itertools.count():
+            started = await self._limiter.acquire_async(tokens)
+            streamed = False
+            try:
+                async for chunk in self._service.complete_chat_stream_async(
+                    messages, settings
+                ):
+                    streamed = True
+                    yield chunk
+            except BaseException as e:
+                self._limiter.release(tokens, success=False)
+                delay = None
+                if isinstance(e, Exception) and not streamed:
+                    delay = self._limiter.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+            else:
+                self._limiter.release(tokens)
+                return
+            await asyncio.sleep(delay)
@@ -0,0 +1,142 @@
+# This file contains the packing of search results into the context sent to
+# create_answer. Adjacent sections of the same source page overlap, so they are
+# merged, near-duplicate sections are removed, and the remaining sections fill a
+# token budget in order of relevance.
+
+from tokens import DEFAULT_ENCODING, count_tokens
+
+
+def merge_overlap(first: str, second: str, min_overlap: int) -> str:
+    """
+    Merge two texts if one contains the other, or if the end of the first is
+    the start of the second. Return None if they do not overlap.
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    # Look for the start of the second text in the end of the first one
+    prefix = second[:min_overlap]
+    position = first.find(prefix, max(0, len(first) - len(second)))
+    while position != -1:
+        if second.startswith(first[position:]):
+            return first[:position] + second
+        position = first.find(prefix, position + 1)
+    return None
+
+
+def shingles(text: str, size: int = 3) -> set:
+    words = text.lower().split()
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+class ContextPacker:
+    """
+    Packs search results, dicts with a reference, a content and a score, into
+    the SOURCES text of create_answer.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 1000,
+        min_overlap: int = 20,
+        duplicate_threshold: float = 0.8,
+        encoding_name: str = DEFAULT_ENCODING,
+    ):
+        self.token_budget = token_budget
+        self.min_overlap = min_overlap
+        self.duplicate_threshold = duplicate_threshold
+        self.encoding_name = encoding_name
+        self._stats = {
+            "packed": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "merged": 0,
+            "duplicates": 0,
+            "over_budget": 0,
+        }
+
+    @staticmethod
+    def format(result: dict) -> str:
+        return result["reference"] + ": " + result["content"]
+
+    def pack(self, results: list) -> str:
+        """
+        Return the packed SOURCES lines of the results, most relevant first.
+        """
+        results = [dict(r) for r in results]
+        tokens = [count_tokens(self.format(r), self.encoding_name) for r in results]
+        self._stats["packed"] += 1
+        self._stats["input_tokens"] += sum(tokens)
+
+        results = self._merge_adjacent(results)
+        results = self._remove_duplicates(results)
+
+        # Fill the budget by relevance, skipping results that do not fit, but
+        # always keep the most relevant one
+        lines = []
+        used = 0
+        for result in sorted(results, key=lambda r: -r["score"]):
+            line = self.format(result)
+            line_tokens = count_tokens(line, self.encoding_name)
+            if lines and used + line_tokens > self.token_budget:
+                self._stats["over_budget"] += 1
+                continue
+            lines.append(line)
+            used += line_tokens
+        self._stats["output_tokens"] += used
+        return "\n".join(lines)
+
+    def _merge_adjacent(self, results: list) -> list:
+        """Merge overlapping results of the same reference."""
+        merged = []
+        for result in results:
+            for other in merged:
+                if other["reference"] != result["reference"]:
+                    continue
+                content = merge_overlap(
+                    other["content"], result["content"], self.min_overlap
+                ) or merge_overlap(
+                    result["content"], other["content"], self.min_overlap
+                )
+                if content is not None:
+                    other["content"] = content
+                    other["score"] = max(other["score"], result["score"])
+                    self._stats["merged"] += 1
+                    break
+            else:
+                merged.append(result)
+        # A merged result can now overlap another one
+        if len(merged) < len(results):
+            return self._merge_adjacent(merged)
+        return merged
+
+    def _remove_duplicates(self, results: list) -> list:
+        """
+        Drop results whose text is mostly contained in a more relevant one.
+        """
+        kept = []
+        kept_shingles = []
+        for result in sorted(results, key=lambda r: -r["score"]):
+            result_shingles = shingles(result["content"])
+            if any(
+                len(result_shingles & s) / len(result_shingles)
+                >= self.duplicate_threshold
+                for s in kept_shingles
+            ):
+                self._stats["duplicates"] += 1
+                continue
+            kept.append(result)
+            kept_shingles.append(result_shingles)
+        return kept
+
+    def stats(self) -> dict:
+        """Return the number of tokens before and after packing."""
+        stats = dict(self._stats)
+        if stats["input_tokens"]:
+            stats["saved_ratio"] = 1 - stats["output_tokens"] / stats["input_tokens"]
+        else:
+            stats["saved_ratio"] = 0.0
+        return stats
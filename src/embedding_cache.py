@@ -0,0 +1,99 @@
+# This file contains a two-tier embedding cache: a bounded in-memory LRU in
+# front of a persistent SQLite store. It is shared by the search plugin and the
+# data preparation script.
+
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+
+from cache import TTLCache
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "embeddings.sqlite"
+)
+
+
+class EmbeddingCache:
+    """
+    Caches embeddings keyed by (deployment, text hash).
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, maxsize: int = 4096):
+        self.path = path
+        self._memory = TTLCache(maxsize=maxsize)
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "deployment TEXT NOT NULL, "
+            "text_hash TEXT NOT NULL, "
+            "vector BLOB NOT NULL, "
+            "PRIMARY KEY (deployment, text_hash))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def _key(deployment: str, text: str) -> tuple:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return (deployment, text_hash)
+
+    def get(self, deployment: str, text: str):
+        """
+        Return the cached embedding of a text, or None if it is not cached.
+        """
+        key = self._key(deployment, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                return vector.tolist()
+
+            row = self._db.execute(
+                "SELECT vector FROM embeddings "
+                "WHERE deployment = ? AND text_hash = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+
+            vector = array("f")
+            vector.frombytes(row[0])
+            self._memory.set(key, vector)
+            self.disk_hits += 1
+        return vector.tolist()
+
+    def set(self, deployment: str, text: str, embedding: list):
+        """
+        Store the embedding of a text in memory and on disk.
+        """
+        key = self._key(deployment, text)
+        vector = array("f", embedding)
+        with self._lock:
+            self._memory.set(key, vector)
+            self._db.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                key + (sqlite3.Binary(vector.tobytes()),),
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters of both tiers.
+        """
+        memory = self._memory.stats()
+        return {
+            "memory_hits": memory["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": memory["misses"] - self.disk_hits,
+            "memory_size": memory["size"],
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,60 @@
+# This file contains the embedding of search queries shared by the search
+# plugins. The embeddings are read from and written to the embedding cache, and
+# the calls go through the rate limiter of the embedding deployment.
+
+import openai
+
+import rate_limit
+import tracing
+from cache import SingleFlight
+from embedding_cache import EmbeddingCache
+from tokens import count_tokens
+
+
+async def create_embedding(
+    text: str,
+    openai_embedding_model: str,
+    embedding_cache: EmbeddingCache,
+    in_flight: SingleFlight = None,
+):
+    """
+    Create an embedding for a given text using OpenAI embedding model, or
+    return None if it could not be created. If in_flight is given, concurrent
+    calls for the same text share one request.
+    """
+    with tracing.span("create_embedding") as span:
+        embedded_text = embedding_cache.get(openai_embedding_model, text)
+        span.set("cache_hit", embedded_text is not None)
+        if embedded_text is not None:
+            return embedded_text
+        try:
+            limiter = rate_limit.get_limiter(openai_embedding_model)
+
+            def call():
+                return limiter.call_async(
+                    lambda: openai.Embedding.acreate(
+                        input=text, deployment_id=openai_embedding_model
+                    ),
+                    tokens=count_tokens(text),
+                    usage=lambda r: r.get("usage", {}).get("prompt_tokens"),
+                )
+
+            if in_flight is not None:
+                response, coalesced = await in_flight.do(
+                    ("embedding", openai_embedding_model, text), call
+                )
+            else:
+                response, coalesced = await call(), False
+            embedded_text = response["data"][0]["embedding"]
+            if coalesced:
+                # The tokens are counted by the call this one waited for
+                span.set("coalesced", True)
+            else:
+                usage = response.get("usage", {})
+                span.set("prompt_tokens", usage.get("prompt_tokens", 0))
+                embedding_cache.set(openai_embedding_model, text, embedded_text)
+        except Exception as e:
+            print(f"Error creating embedding for text: {text} with error: {e}")
+            span.set("error", type(e).__name__)
+            embedded_text = None
+        return embedded_text
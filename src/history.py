@@ -0,0 +1,102 @@
+# This file contains the policy that keeps the chat history of a chat semantic
+# function within a token budget.
+
+from tokens import DEFAULT_ENCODING, count_tokens
+
+SUMMARY_HEADER = "Summary of the earlier conversation, the user asked about:"
+
+
+class ChatHistoryCompactor:
+    """
+    Keeps the system message and the most recent messages of a chat history
+    that fit in a token budget. Older user messages can be folded into a
+    running summary message instead of being dropped.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 1500,
+        summarize: bool = True,
+        summary_token_budget: int = 200,
+        encoding_name: str = DEFAULT_ENCODING,
+    ):
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.summary_token_budget = summary_token_budget
+        self.encoding_name = encoding_name
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.encoding_name)
+
+    def compact(self, prompt_template):
+        """
+        Compact the chat history of a ChatPromptTemplate in place.
+        """
+        messages = prompt_template._messages
+        head = 0
+        while head < len(messages) and messages[head][0] == "system":
+            head += 1
+        system = [m for m in messages[:head] if not self._is_summary(m)]
+        summary = [m for m in messages[:head] if self._is_summary(m)]
+        history = messages[head:]
+
+        # Keep the most recent user messages and their replies within the
+        # budget, and at least the last ones, so that the kept history does not
+        # start with a reply to a question folded into the summary
+        start = len(history)
+        tokens = 0
+        while start > 0:
+            pair_start = start - 1
+            while pair_start > 0 and history[pair_start][0] != "user":
+                pair_start -= 1
+            tokens += sum(
+                self.count_tokens(template._template)
+                for _, template in history[pair_start:start]
+            )
+            if tokens > self.token_budget and start < len(history):
+                break
+            start = pair_start
+        kept = len(history) - start
+        if kept == len(history):
+            return
+
+        dropped = history[: len(history) - kept]
+        history = history[len(history) - kept :]
+        if self.summarize:
+            lines = self._summary_lines(summary)
+            lines += [
+                " ".join(template._template.split())
+                for role, template in dropped
+                if role == "user"
+            ]
+            summary = self._summary_message(prompt_template, lines)
+
+        messages[:] = system + summary + history
+
+    def _is_summary(self, message) -> bool:
+        return message[0] == "system" and message[1]._template.startswith(
+            SUMMARY_HEADER
+        )
+
+    def _summary_lines(self, summary: list) -> list:
+        if not summary:
+            return []
+        text = summary[0][1]._template[len(SUMMARY_HEADER) :]
+        return [line[2:] for line in text.strip().split("\n") if line]
+
+    def _summary_message(self, prompt_template, lines: list) -> list:
+        # Keep the most recent lines within the summary budget
+        kept = []
+        tokens = self.count_tokens(SUMMARY_HEADER)
+        for line in reversed(lines):
+            tokens += self.count_tokens(line)
+            if tokens > self.summary_token_budget:
+                break
+            kept.insert(0, line)
+        if not kept:
+            return []
+
+        text = SUMMARY_HEADER + "\n" + "\n".join(f"- {line}" for line in kept)
+        # Create the message with the template, then take it out of the history
+        prompt_template.add_system_message(text)
+        return [prompt_template._messages.pop()]
@@ -0,0 +1,68 @@
+# This file contains the version stamp of the search index. The data
+# preparation script bumps the version after changing an index, and the search
+# plugin uses it to invalidate cached results.
+
+import json
+import os
+import time
+
+DEFAULT_VERSION_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "index_version.json"
+)
+
+
+def read_index_versions(path: str = DEFAULT_VERSION_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def bump_index_version(index_name: str, path: str = DEFAULT_VERSION_PATH) -> str:
+    """
+    Record a new version of an index, and return it.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    versions = read_index_versions(path)
+    versions[index_name] = f"{time.time():.6f}"
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(versions, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+    return versions[index_name]
+
+
+class IndexVersion:
+    """
+    Tracks the current version of an index, re-reading the version stamp at
+    most every check_interval seconds.
+    """
+
+    def __init__(
+        self,
+        index_name: str,
+        path: str = DEFAULT_VERSION_PATH,
+        check_interval: float = 5,
+    ):
+        self.index_name = index_name
+        self.path = path
+        self.check_interval = check_interval
+        self._version = None
+        self._mtime = None
+        self._checked_at = None
+
+    def current(self) -> str:
+        now = time.monotonic()
+        if self._checked_at is not None:
+            if now - self._checked_at < self.check_interval:
+                return self._version
+        self._checked_at = now
+
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            versions = read_index_versions(self.path)
+            self._version = versions.get(self.index_name)
+        return self._version
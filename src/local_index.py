@@ -0,0 +1,192 @@
+# This file contains an in-process search index for small knowledge bases. It
+# combines a vector index, kept in a memory-mapped NumPy matrix, with a BM25
+# text index, using reciprocal rank fusion. It mimics the upload_documents and
+# delete_documents calls of the Azure SearchClient so that the data preparation
+# script can fill it in the same way.
+
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+DOCUMENT_FIELDS = ["id", "content", "category", "source_page", "source_file"]
+
+
+class IndexingResult:
+    """The result of indexing one document, like the Azure SDK returns."""
+
+    def __init__(self, key: str, succeeded: bool = True):
+        self.key = key
+        self.succeeded = succeeded
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LocalSearchIndex:
+    """
+    A hybrid vector and BM25 index stored in a directory.
+    """
+
+    def __init__(self, index_dir: str, k1: float = 1.2, b: float = 0.75):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self._documents = []
+        self._vectors = None
+        self._positions = {}
+        # Documents changed since the index was loaded, by ID
+        self._pending = None
+
+        if os.path.exists(self._documents_path):
+            self.load()
+
+    @property
+    def _documents_path(self):
+        return os.path.join(self.index_dir, "documents.jsonl")
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.index_dir, "vectors.npy")
+
+    def __len__(self):
+        return len(self._documents)
+
+    def load(self):
+        """Load the documents and memory-map the vectors of the index."""
+        with open(self._documents_path, "r") as f:
+            self._documents = [json.loads(line) for line in f]
+        self._vectors = np.load(self._vectors_path, mmap_mode="r")
+        self._positions = {d["id"]: i for i, d in enumerate(self._documents)}
+        self._build_text_index()
+
+    def _build_text_index(self):
+        """Build the BM25 inverted index of the document contents."""
+        self._postings = defaultdict(list)
+        self._lengths = np.zeros(len(self._documents), dtype=np.float32)
+        for position, document in enumerate(self._documents):
+            terms = Counter(tokenize(document["content"]))
+            self._lengths[position] = sum(terms.values())
+            for term, frequency in terms.items():
+                self._postings[term].append((position, frequency))
+        self._average_length = float(self._lengths.mean()) if len(self) else 0.0
+
+    # Writing, with the same calls as the Azure SearchClient
+
+    def _pending_documents(self) -> dict:
+        if self._pending is None:
+            # Copy the vectors out of the memory map, which save() replaces
+            vectors = np.array(self._vectors) if self._vectors is not None else []
+            self._pending = {
+                d["id"]: (d, vectors[i]) for i, d in enumerate(self._documents)
+            }
+        return self._pending
+
+    def upload_documents(self, documents: list) -> list:
+        """Add or replace documents, written to disk on save()."""
+        pending = self._pending_documents()
+        results = []
+        for document in documents:
+            vector = document.get("content_vector")
+            if vector is None:
+                results.append(IndexingResult(document["id"], False))
+                continue
+            fields = {name: document.get(name) for name in DOCUMENT_FIELDS}
+            pending[document["id"]] = (fields, np.asarray(vector, dtype=np.float32))
+            results.append(IndexingResult(document["id"]))
+        return results
+
+    def delete_documents(self, documents: list) -> list:
+        pending = self._pending_documents()
+        for document in documents:
+            pending.pop(document["id"], None)
+        return [IndexingResult(document["id"]) for document in documents]
+
+    def save(self):
+        """
+        Write the documents and their normalized vectors to the index
+        directory, then reload the index.
+        """
+        if self._pending is None:
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        ids = sorted(self._pending)
+        documents = [self._pending[i][0] for i in ids]
+        if ids:
+            vectors = np.stack([self._pending[i][1] for i in ids])
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+
+        # Release the memory map and replace the files
+        self._vectors = None
+        temp_path = os.path.join(self.index_dir, "vectors.tmp.npy")
+        np.save(temp_path, vectors.astype(np.float32))
+        os.replace(temp_path, self._vectors_path)
+        temp_path = self._documents_path + ".tmp"
+        with open(temp_path, "w") as f:
+            for document in documents:
+                f.write(json.dumps(document) + "\n")
+        os.replace(temp_path, self._documents_path)
+        self._pending = None
+        self.load()
+
+    # Searching
+
+    def _vector_ranking(self, vector, top_k: int) -> list:
+        if vector is None or not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self._vectors @ query
+        return self._top(scores, top_k)
+
+    def _text_ranking(self, text: str, top_k: int) -> list:
+        if not len(self):
+            return []
+        scores = np.zeros(len(self._documents), dtype=np.float32)
+        count = len(self._documents)
+        for term in set(tokenize(text)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            positions = np.fromiter((p for p, _ in postings), dtype=np.int64)
+            frequencies = np.fromiter((f for _, f in postings), dtype=np.float32)
+            norm = self.k1 * (
+                1 - self.b + self.b * self._lengths[positions] / self._average_length
+            )
+            scores[positions] += (
+                idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+            )
+        return [p for p in self._top(scores, top_k) if scores[p] > 0]
+
+    @staticmethod
+    def _top(scores, top_k: int) -> list:
+        top_k = min(top_k, len(scores))
+        if top_k <= 0:
+            return []
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        return sorted(candidates.tolist(), key=lambda p: (-scores[p], p))
+
+    def search(self, text: str, vector=None, top: int = 5, top_k: int = 10) -> list:
+        """
+        Return the top documents for a query, fusing the vector and the text
+        rankings with reciprocal rank fusion.
+        """
+        rrf_k = 60
+        fused = defaultdict(float)
+        for ranking in (
+            self._vector_ranking(vector, top_k),
+            self._text_ranking(text, top_k),
+        ):
+            for rank, position in enumerate(ranking):
+                fused[position] += 1 / (rrf_k + rank + 1)
+        positions = sorted(fused, key=lambda p: (-fused[p], p))[:top]
+        return [dict(self._documents[p], score=fused[p]) for p in positions]
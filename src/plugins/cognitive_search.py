@@ -1,12 +1,18 @@
 # This plugin uses Azure Cognitive Search to search a knowledge base for a query.
 
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents.aio import SearchClient
-from dotenv import dotenv_values
 from semantic_kernel.orchestration.sk_context import SKContext
 from semantic_kernel.skill_definition import sk_function, sk_function_context_parameter
 import openai
 
+import embeddings
+import rate_limit
+import tracing
+from cache import SingleFlight, TTLCache
+from context_packing import ContextPacker
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from index_version import IndexVersion
+from settings import load_settings
+
 
 class AzureCognitiveSearch:
     def __init__(
@@ -17,51 +23,136 @@ class AzureCognitiveSearch:
         content_field=None,
         reference_field=None,
         top=5,
+        pool_size=100,
+        keepalive_timeout=30,
+        embedding_cache=None,
+        context_packer=None,
+        search_cache_size=1024,
+        search_cache_ttl=300,
+        config=None,
     ):
         # load config
-        config = dotenv_values("../.env")
+        config = config if config is not None else load_settings()
         self.endpoint = (
-            endpoint or f"https://{config['AZURE_SEARCH_SERVICE']}.search.windows.net/"
+            endpoint
+            or config.get("AZURE_SEARCH_ENDPOINT")
+            or f"https://{config['AZURE_SEARCH_SERVICE']}.search.windows.net/"
         )
         self.key = key or config["AZURE_SEARCH_KEY"]
         self.index_name = index_name or config["AZURE_SEARCH_INDEX"]
         self.content_field = content_field or config["AZURE_SEARCH_CONTENT_FIELD"]
         self.reference_field = reference_field or config["AZURE_SEARCH_REFERENCE_FIELD"]
         self.top = top
+        self.top_k = 10
+        # Connection pool shared by all queries, created on first use
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._search_client = None
+        self._pool_stats = {
+            "clients_created": 0,
+            "queries": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+        }
         # OpenAI for vector search
         openai.api_base = config["AZURE_OPENAI_ENDPOINT"]
         openai.api_version = "2022-12-01"
         openai.api_type = "azure"
         openai.api_key = config["AZURE_OPENAI_API_KEY"]
         self._openai_embedding_model = config["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
+        rate_limit.get_limiter(
+            self._openai_embedding_model,
+            **rate_limit.limits_from_settings(config, "AZURE_OPENAI_EMBEDDING"),
+        )
+        self._embedding_cache = embedding_cache or EmbeddingCache(
+            config.get("EMBEDDING_CACHE_PATH") or DEFAULT_CACHE_PATH
+        )
+        # Merges, dedupes and trims the results to the context token budget
+        self.context_packer = context_packer or ContextPacker()
+        # Formatted search results, invalidated when the index is refreshed
+        self._search_cache = TTLCache(maxsize=search_cache_size, ttl=search_cache_ttl)
+        self._index_version = IndexVersion(self.index_name)
+        self._cached_index_version = None
+        # Embedding and search calls in flight, shared by identical requests
+        self._in_flight = SingleFlight()
 
         print("Loaded Azure Cognitive Search Plugin")
 
     def get_search_client(self):
-        """Create a SearchClient to query the index."""
-        return SearchClient(
-            endpoint=self.endpoint,
-            index_name=self.index_name,
-            credential=AzureKeyCredential(self.key),
-        )
+        """
+        Return the long-lived SearchClient used to query the index, creating
+        it and its connection pool on first use.
+        """
+        if self._search_client is None:
+            # Import the Azure SDK on first use, it is slow to import
+            import aiohttp
+            from azure.core.credentials import AzureKeyCredential
+            from azure.core.pipeline.transport import AioHttpTransport
+            from azure.search.documents.aio import SearchClient
 
-    async def create_embedding(self, text, openai_embedding_model):
-        """Create an embedding for a given text using OpenAI embedding model."""
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._search_client = SearchClient(
+                endpoint=self.endpoint,
+                index_name=self.index_name,
+                credential=AzureKeyCredential(self.key),
+                transport=AioHttpTransport(
+                    session=self._session, session_owner=False
+                ),
+            )
+            self._pool_stats["clients_created"] += 1
+        return self._search_client
+
+    async def warm_up(self):
+        """
+        Open a pooled connection to the search service before the first query.
+        """
         try:
-            embedded_text = (
-                await openai.Embedding.acreate(
-                    input=text, deployment_id=openai_embedding_model
-                )
-            )["data"][0]["embedding"]
+            await self.get_search_client().get_document_count()
         except Exception as e:
-            print(f"Error creating embedding for text: {text} with error: {e}")
-            embedded_text = None
-        return embedded_text
+            print(f"Error warming up the search connection: {e}")
+
+    async def close(self):
+        """Close the SearchClient, its connection pool and the embedding cache."""
+        if self._search_client is not None:
+            await self._search_client.close()
+            self._search_client = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._embedding_cache.close()
+
+    def pool_stats(self) -> dict:
+        """Return usage statistics of the search connection pool."""
+        stats = dict(self._pool_stats)
+        stats["pool_size"] = self.pool_size
+        stats["open"] = self._session is not None and not self._session.closed
+        return stats
+
+    def search_cache_stats(self) -> dict:
+        """Return the hit/miss counters of the search result cache."""
+        stats = self._search_cache.stats()
+        stats["index_version"] = self._cached_index_version
+        stats["in_flight"] = self._in_flight.stats()
+        return stats
+
+    async def create_embedding(self, text, openai_embedding_model):
+        """Create an embedding for a given text using OpenAI embedding model."""
+        return await embeddings.create_embedding(
+            text, openai_embedding_model, self._embedding_cache, self._in_flight
+        )
 
     async def remove_newlines(self, s):
         s = s.replace("\n", " ").replace("\r", " ")
         return s
 
+    async def embed_query(self, text):
+        """Create an embedding of a text with the embedding model of the index."""
+        return await self.create_embedding(text, self._openai_embedding_model)
+
     @sk_function(
         description="Given a query, search an index and return the results.",
         name="search",
@@ -72,26 +163,70 @@ class AzureCognitiveSearch:
     )
     async def search(self, context: SKContext) -> str:
         query = context["input"]
+
+        # Drop cached results of a previous version of the index
+        index_version = self._index_version.current()
+        if index_version != self._cached_index_version:
+            self._search_cache.clear()
+            self._cached_index_version = index_version
+
+        cache_key = (self.index_name, query, self.top, self.top_k)
+        content = self._search_cache.get(cache_key)
+        span = tracing.current_span()
+        if span is not None:
+            span.set("cache_hit", content is not None)
+        if content is None:
+            # Share the search of the same query sent by another session
+            (content, embedded), coalesced = await self._in_flight.do(
+                ("search", index_version) + cache_key,
+                lambda: self._search_index(query),
+            )
+            if span is not None and coalesced:
+                span.set("coalesced", True)
+            if embedded:
+                # Without the embedding only the text search ran, do not keep
+                # its results after the embedding service recovers
+                self._search_cache.set(cache_key, content)
+
+        context["search_result"] = "\nSOURCES:\n" + content
+
+        return content
+
+    async def search_index(self, query: str) -> str:
+        """Run a hybrid text and vector query against the index."""
+        content, _ = await self._search_index(query)
+        return content
+
+    async def _search_index(self, query: str) -> tuple:
+        """
+        Run a hybrid text and vector query against the index, and return the
+        results and whether the query could be embedded.
+        """
         embedded_query = await self.create_embedding(
             query, self._openai_embedding_model
         )
         search_client = self.get_search_client()
-        async with search_client:
+        self._pool_stats["queries"] += 1
+        self._pool_stats["in_flight"] += 1
+        self._pool_stats["peak_in_flight"] = max(
+            self._pool_stats["peak_in_flight"], self._pool_stats["in_flight"]
+        )
+        try:
             r = await search_client.search(
                 search_text=query,
                 top=self.top,
                 vector_fields="content_vector",
                 vector=embedded_query,
-                top_k=10,
+                top_k=self.top_k,
             )
             results = [
-                doc[self.reference_field]
-                + ": "
-                + await self.remove_newlines(doc[self.content_field])
+                {
+                    "reference": doc[self.reference_field],
+                    "content": await self.remove_newlines(doc[self.content_field]),
+                    "score": doc["@search.score"],
+                }
                 async for doc in r
             ]
-            content = "\n".join(results)
-
-        context["search_result"] = "\nSOURCES:\n" + content
-
-        return content
+        finally:
+            self._pool_stats["in_flight"] -= 1
+        return self.context_packer.pack(results), embedded_query is not None
@@ -0,0 +1,125 @@
+# This plugin searches a local in-process index for a query. It is a drop-in
+# replacement for the Azure Cognitive Search plugin for small knowledge bases.
+
+from semantic_kernel.orchestration.sk_context import SKContext
+from semantic_kernel.skill_definition import sk_function, sk_function_context_parameter
+import openai
+
+import embeddings
+import rate_limit
+from context_packing import ContextPacker
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from index_version import IndexVersion
+from local_index import LocalSearchIndex
+from settings import load_settings
+
+
+class LocalSearch:
+    def __init__(
+        self,
+        index_dir=None,
+        reference_field=None,
+        top=5,
+        embedding_cache=None,
+        context_packer=None,
+        config=None,
+    ):
+        # load config
+        config = config if config is not None else load_settings()
+        self.index_dir = index_dir or config["LOCAL_SEARCH_INDEX_DIR"]
+        # The data preparation script versions the index by its directory
+        self.index_name = self.index_dir
+        self.reference_field = reference_field or config.get(
+            "AZURE_SEARCH_REFERENCE_FIELD", "source_page"
+        )
+        self.top = top
+        self.top_k = 10
+        self.index = LocalSearchIndex(self.index_dir)
+        # Reload the index when the data preparation script changes it
+        self._index_version = IndexVersion(self.index_name)
+        self._loaded_index_version = self._index_version.current()
+        # OpenAI for vector search
+        openai.api_base = config["AZURE_OPENAI_ENDPOINT"]
+        openai.api_version = "2022-12-01"
+        openai.api_type = "azure"
+        openai.api_key = config["AZURE_OPENAI_API_KEY"]
+        self._openai_embedding_model = config["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
+        rate_limit.get_limiter(
+            self._openai_embedding_model,
+            **rate_limit.limits_from_settings(config, "AZURE_OPENAI_EMBEDDING"),
+        )
+        self._embedding_cache = embedding_cache or EmbeddingCache(
+            config.get("EMBEDDING_CACHE_PATH") or DEFAULT_CACHE_PATH
+        )
+        # Merges, dedupes and trims the results to the context token budget
+        self.context_packer = context_packer or ContextPacker()
+
+        print(f"Loaded Local Search Plugin with {len(self.index)} documents")
+
+    async def warm_up(self):
+        """The local index is loaded when the plugin is created."""
+
+    async def close(self):
+        """Close the embedding cache."""
+        self._embedding_cache.close()
+
+    def pool_stats(self) -> dict:
+        """The local index does not use a connection pool."""
+        return {}
+
+    def search_cache_stats(self) -> dict:
+        """The local index does not cache search results."""
+        return {}
+
+    def _reload_if_changed(self):
+        """Load the index again if a newer version was recorded."""
+        index_version = self._index_version.current()
+        if index_version == self._loaded_index_version:
+            return
+        # Replace the index at once, so that no search sees it half loaded
+        self.index = LocalSearchIndex(self.index_dir)
+        self._loaded_index_version = index_version
+        print(f"Reloaded the local search index with {len(self.index)} documents")
+
+    async def create_embedding(self, text, openai_embedding_model):
+        """Create an embedding for a given text using OpenAI embedding model."""
+        return await embeddings.create_embedding(
+            text, openai_embedding_model, self._embedding_cache
+        )
+
+    async def embed_query(self, text):
+        """Create an embedding of a text with the embedding model of the index."""
+        return await self.create_embedding(text, self._openai_embedding_model)
+
+    @sk_function(
+        description="Given a query, search an index and return the results.",
+        name="search",
+    )
+    @sk_function_context_parameter(
+        name="input",
+        description="The query to search for in the knowledge base",
+    )
+    async def search(self, context: SKContext) -> str:
+        query = context["input"]
+        self._reload_if_changed()
+        content = await self.search_index(query)
+
+        context["search_result"] = "\nSOURCES:\n" + content
+
+        return content
+
+    async def search_index(self, query: str) -> str:
+        """Run a hybrid text and vector query against the local index."""
+        embedded_query = await self.create_embedding(
+            query, self._openai_embedding_model
+        )
+        documents = self.index.search(query, embedded_query, self.top, self.top_k)
+        results = [
+            {
+                "reference": doc[self.reference_field],
+                "content": doc["content"].replace("\n", " ").replace("\r", " "),
+                "score": doc["score"],
+            }
+            for doc in documents
+        ]
+        return self.context_packer.pack(results)
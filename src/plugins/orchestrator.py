@@ -1,6 +1,8 @@
 # This plugin is used to orchestrate the execution of a plan.
 
 import ast
+import asyncio
+import json
 import re
 
 from semantic_kernel import Kernel
@@ -11,16 +13,90 @@ from semantic_kernel.semantic_functions.semantic_function_config import (
 )
 from semantic_kernel.skill_definition import sk_function
 
+import tracing
+from cache import TTLCache
+from tokens import count_tokens, estimate_tokens
+
+# Matches the list the planner returns, e.g. ["acs_plugin.search"]
+PLAN_PATTERN = re.compile(r"\[.*\]", re.DOTALL)
+# Matches the object the fused planner returns, e.g.
+# {"plan": ["acs_plugin.search"], "search_query": "eye exam coverage"}
+PLAN_AND_QUERY_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+# The context variables each function reads and writes, used to find the
+# functions of a plan that can run concurrently. Every function writes its
+# result to "input".
+FUNCTION_IO = {
+    "knowledge_base_search.create_search_query": (("user_input",), ("input",)),
+    "acs_plugin.search": (("input",), ("input", "search_result")),
+    "knowledge_base_search.create_answer": (
+        ("search_result", "user_input"),
+        ("input",),
+    ),
+    "knowledge_base_search.safety_share": (("user_input",), ("input",)),
+}
+
+# Semantic functions whose output can be streamed token by token
+STREAMING_FUNCTIONS = {
+    "knowledge_base_search.create_answer",
+    "knowledge_base_search.safety_share",
+}
+# The semantic kernel starts a streamed chat completion with its role
+STREAM_ROLE_PREFIX = "assistant: "
+
+
+class StepError(Exception):
+    """Raised when a function of a plan fails."""
+
 
 class Orchestrator:
     def __init__(
         self,
         kernel: Kernel,
         chat_function_config: SemanticFunctionConfig = None,
+        plan_cache_size: int = 256,
+        plan_cache_ttl: float = 3600,
+        router=None,
+        function_io: dict = None,
+        history_compactor=None,
+        function_configs: dict = None,
+        tracer=None,
+        answer_cache=None,
+        fused_planner: bool = False,
+        speculative_search: bool = False,
     ):
         self._kernel = kernel
         self._chat_function_config = chat_function_config
         self._functions = self._create_available_functions_string(kernel)
+        # Plans keyed on the normalized request text
+        self.plan_cache = TTLCache(maxsize=plan_cache_size, ttl=plan_cache_ttl)
+        # Optional local router that can produce a plan without the planner
+        self._router = router
+        # Inputs and outputs of the functions, see FUNCTION_IO
+        self._function_io = dict(FUNCTION_IO)
+        self._function_io.update(function_io or {})
+        # Optional policy keeping the chat history within a token budget
+        self._history_compactor = history_compactor
+        # Configs of the semantic functions by "plugin.function", used to
+        # estimate the prompt tokens of a step
+        self._function_configs = function_configs or {}
+        # Traces every request, see tracing.py
+        self.tracer = tracer or tracing.Tracer()
+        # Optional cache of the answers to past questions, see answer_cache.py
+        self.answer_cache = answer_cache
+        # Create the plan and the search query with one planning.plan_and_query
+        # call instead of planning.planner and create_search_query
+        self._fused_planner = fused_planner
+        # Search for the raw request while the planner runs, see
+        # _start_speculative_search
+        self._speculative_search = speculative_search
+        self._speculation_stats = {
+            "started": 0,
+            "used": 0,
+            "unused": 0,
+            "cancelled": 0,
+            "failed": 0,
+        }
         print("Loaded Orchestrator Plugin.")
 
     def _create_available_functions_string(self, kernel: Kernel):
@@ -39,46 +115,381 @@ class Orchestrator:
 
         return function_list
 
+    @staticmethod
+    def _normalize_request(request: str) -> str:
+        """
+        Normalize a request so that trivial variations share a cache entry.
+        """
+        return " ".join(request.lower().split())
+
+    @staticmethod
+    def _parse_plan(planner_output: str) -> list:
+        """
+        Convert the output of the planner into a list of tasks. Returns None
+        if the output does not contain a valid plan.
+        """
+        match = PLAN_PATTERN.match(planner_output.strip())
+        if match is None:
+            print(f"No plan found: {planner_output}")
+            return None
+        try:
+            tasks = ast.literal_eval(match.group(0))
+        except (ValueError, SyntaxError):
+            print(f"Invalid plan: {planner_output}")
+            return None
+        return tasks if isinstance(tasks, list) else None
+
+    @classmethod
+    def _parse_plan_and_query(cls, planner_output: str) -> tuple:
+        """
+        Convert the output of the fused planner into a list of tasks and a
+        search query. The search query is None if there is none, and the tasks
+        are None if the output does not contain a valid plan.
+        """
+        match = PLAN_AND_QUERY_PATTERN.search(planner_output)
+        if match is None:
+            # Fall back to a plan without a search query
+            return cls._parse_plan(planner_output), None
+        try:
+            output = json.loads(match.group(0))
+        except ValueError:
+            print(f"Invalid plan: {planner_output}")
+            return None, None
+        tasks = output.get("plan") if isinstance(output, dict) else None
+        if not isinstance(tasks, list):
+            print(f"No plan found: {planner_output}")
+            return None, None
+        search_query = output.get("search_query")
+        if not isinstance(search_query, str) or not search_query.strip():
+            search_query = None
+        return tasks, search_query
+
+    def _get_function(self, plugin_name: str, function_name: str, session=None):
+        """
+        Return a function of the kernel, or the session's own copy of it.
+        """
+        if session is not None:
+            function = session.get_function(plugin_name, function_name)
+            if function is not None:
+                return function
+        return self._kernel.skills.get_function(plugin_name, function_name)
+
+    def _estimate_prompt_tokens(
+        self, subtask: str, variables: ContextVariables, session=None
+    ) -> int:
+        """
+        Estimate the prompt tokens of a semantic function from the length of
+        its chat history and the variables it reads. The history grows with
+        every turn, so it is not tokenized again for each step.
+        """
+        function_config = None
+        if session is not None:
+            function_config = session.function_configs.get(subtask)
+        if function_config is None:
+            function_config = self._function_configs.get(subtask)
+        tokens = 0
+        if function_config is not None:
+            tokens += sum(
+                estimate_tokens(template._template)
+                for _, template in function_config.prompt_template._messages
+            )
+        io = self._function_io.get(subtask)
+        reads = io[0] if io is not None else ("input",)
+        tokens += sum(
+            estimate_tokens(variables[name])
+            for name in reads
+            if variables.contains_key(name)
+        )
+        return tokens
+
+    async def create_plan_async(self, context: SKContext, session=None) -> list:
+        """
+        Generate a step-by-step execution plan for the request in the context.
+        """
+        tasks, _ = await self.create_plan_and_query_async(context, session)
+        return tasks
+
+    async def create_plan_and_query_async(
+        self, context: SKContext, session=None
+    ) -> tuple:
+        """
+        Generate a step-by-step execution plan for the request in the context,
+        and the search query if the fused planner created one. The local router
+        is tried first, then the plan cache, and only then the planner.
+        """
+        with tracing.span("planner") as span:
+            if self._router is not None:
+                tasks = self._router.route(context["input"])
+                if tasks is not None:
+                    span.set("source", "router")
+                    return tasks, None
+
+            cache_key = self._normalize_request(context["input"])
+            tasks = self.plan_cache.get(cache_key)
+            span.set("cache_hit", tasks is not None)
+            if tasks is not None:
+                span.set("source", "cache")
+                return list(tasks), None
+
+            span.set("source", "planner")
+            planner_name = "plan_and_query" if self._fused_planner else "planner"
+            span.set("fused", self._fused_planner)
+            span.set(
+                "prompt_tokens",
+                self._estimate_prompt_tokens(
+                    f"planning.{planner_name}", context.variables, session
+                ),
+            )
+            planner_func = self._get_function("planning", planner_name, session)
+            planner_context = await planner_func.invoke_async(context=context)
+            span.set("completion_tokens", count_tokens(planner_context.result))
+            if self._fused_planner:
+                tasks, search_query = self._parse_plan_and_query(
+                    planner_context.result
+                )
+            else:
+                tasks, search_query = self._parse_plan(planner_context.result), None
+            if tasks is None:
+                # Do not cache a failed planner round trip
+                return [], None
+            # The search query depends on the chat history, only cache the plan
+            self.plan_cache.set(cache_key, tuple(tasks))
+            return tasks, search_query
+
     @sk_function(
         description="Process the request based on an execution plan.",
         name="process_request",
     )
     async def process_request(self, context: SKContext) -> str:
+        return await self.process_request_async(context)
+
+    async def process_request_stream_async(
+        self, request: str, on_token=None, session=None
+    ) -> str:
+        """
+        Process the request, passing the tokens of the final answer to
+        on_token as they are generated, if given. Returns the full answer.
+        The chat history of the session is used if a session is given.
+        """
+        context = self._kernel.create_new_context()
+        context["input"] = request
+        return await self.process_request_async(context, on_token, session)
+
+    async def process_request_async(
+        self, context: SKContext, on_token=None, session=None
+    ) -> str:
+        session_id = session.session_id if session is not None else None
+        with self.tracer.trace(context["input"], session_id):
+            return await self._process_request_async(context, on_token, session)
+
+    def _history_context(self, session=None) -> tuple:
+        """
+        Return the last user messages of the chat history that an answer
+        depends on, normalized.
+        """
+        chat_function_config = self._chat_function_config_for(session)
+        if chat_function_config is None or self.answer_cache is None:
+            return ()
+        user_messages = [
+            self._normalize_request(template._template)
+            for role, template in chat_function_config.prompt_template._messages
+            if role == "user"
+        ]
+        turns = self.answer_cache.context_turns
+        return tuple(user_messages[len(user_messages) - turns :]) if turns else ()
+
+    def _has_chat_history(self, session=None) -> bool:
+        """Return whether the chat history has previous user messages."""
+        chat_function_config = self._chat_function_config_for(session)
+        if chat_function_config is None:
+            return False
+        return any(
+            role == "user"
+            for role, _ in chat_function_config.prompt_template._messages
+        )
+
+    def _start_speculative_search(self, request: str, session=None) -> dict:
+        """
+        Start a search for the raw request, to be used by the search step of
+        the plan if it searches for the same query. It is only started without
+        a chat history, when the plan searches for the raw request.
+        """
+        self._speculation_stats["started"] += 1
+
+        async def search():
+            with tracing.span("speculative_search"):
+                search_func = self._get_function("acs_plugin", "search", session)
+                output = await search_func.invoke_async(
+                    variables=ContextVariables(request)
+                )
+                if output.error_occurred:
+                    raise output.last_exception
+                return {
+                    "input": output.result,
+                    "search_result": output.variables["search_result"],
+                }
+
+        return {"query": request, "task": asyncio.ensure_future(search())}
+
+    def _discard_speculation(self, speculation: dict):
+        """Cancel a speculative search whose result is not needed."""
+        if speculation is None or speculation.get("consumed"):
+            return
+        speculation["consumed"] = True
+        self._speculation_stats["cancelled"] += 1
+        task = speculation["task"]
+        if task.done():
+            if not task.cancelled():
+                # Retrieve the exception, if any, so that it is not logged
+                task.exception()
+        else:
+            task.cancel()
+
+    async def _speculative_search_result(self, speculation: dict, query: str):
+        """
+        Return the output of the speculative search if it searched for the
+        query, or None. Otherwise it is left to finish, as it still fills the
+        search and embedding caches, but its results are not used.
+        """
+        if speculation.get("consumed"):
+            return None
+        speculation["consumed"] = True
+        if self._normalize_request(query) != self._normalize_request(
+            speculation["query"]
+        ):
+            self._speculation_stats["unused"] += 1
+            # Retrieve the exception, if any, so that it is not logged
+            speculation["task"].add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+            return None
+        try:
+            variables = await speculation["task"]
+        except Exception as e:
+            print(f"Speculative search failed: {e}")
+            self._speculation_stats["failed"] += 1
+            return None
+        self._speculation_stats["used"] += 1
+        return variables
+
+    def speculation_stats(self) -> dict:
+        """Return how often speculative searches were used or wasted."""
+        stats = dict(self._speculation_stats)
+        stats["wasted"] = stats["unused"] + stats["cancelled"] + stats["failed"]
+        stats["waste_rate"] = (
+            stats["wasted"] / stats["started"] if stats["started"] else 0.0
+        )
+        return stats
+
+    async def _process_request_async(
+        self, context: SKContext, on_token=None, session=None
+    ) -> str:
         # Save the original request, to be used to form a plan
         request = context["input"]
 
-        # Generate a step-by-step execution plan based on the request
-        planner_func = self._kernel.skills.get_function("planning", "planner")
-        planner_func(context=context)
+        # Answer from the cache if the question, or a paraphrase of it, was
+        # answered before in the same context
+        if self.answer_cache is not None:
+            question = self._normalize_request(request)
+            history_context = self._history_context(session)
+            with tracing.span("answer_cache") as span:
+                answer, vector = await self.answer_cache.lookup(
+                    question, history_context, request
+                )
+                span.set("cache_hit", answer is not None)
+            if answer is not None:
+                print("\n  |Backend: Cached answer|\n")
+                if on_token is not None:
+                    on_token(answer)
+                await self.maintain_chat_history(request, 0, answer, session)
+                return answer
 
-        # Convert the output of the planner into a list
-        list_pattern = r"\[.*\]"
+        # Search for the raw request while the planner runs. With a chat
+        # history the query is rewritten with it, so it would not be used.
+        speculation = None
+        if self._speculative_search and not self._has_chat_history(session):
+            speculation = self._start_speculative_search(request, session)
 
-        if re.match(list_pattern, context["input"]):
-            tasks = ast.literal_eval(context["input"])
-        else:
-            print(f"No plan found: {context['input']}")
-            tasks = []
+        try:
+            # Generate a step-by-step execution plan based on the request
+            tasks, search_query = await self.create_plan_and_query_async(
+                context, session
+            )
+            plan = {"input": request, "tasks": tasks, "search_query": search_query}
+            print(f"\n  |Backend: Plan|: {tasks}\n")
+
+            # Check if the task list contain unknown functions
+            for task in tasks:
+                if task not in self._functions:
+                    return "I am sorry. I could not find an answer to your question."
 
-        plan = {"input": request, "tasks": tasks}
-        print("-" * 50)
-        print(f"\n  |Backend: Plan|: {tasks}\n")
+            if speculation is not None and "acs_plugin.search" in tasks:
+                plan["speculative_search"] = speculation
+                if search_query is None:
+                    # Without a chat history there is nothing to rewrite the
+                    # request with, skip create_search_query and search for it
+                    plan["search_query"] = request
 
-        # Check if the task list contain unknown functions
-        for task in tasks:
-            if task not in self._functions:
+            # Execute the plan
+            try:
+                result = await self.execute_plan_async(
+                    plan, self._kernel, on_token, session
+                )
+            except StepError as e:
+                print(f"\n  |Backend: Error|: {e}\n")
                 return "I am sorry. I could not find an answer to your question."
+        finally:
+            self._discard_speculation(speculation)
 
-        # Execute the plan
-        result = await self.execute_plan_async(plan, self._kernel)
-        print("-" * 50)
+        # Only answers from the knowledge base are cached. Failed steps raise
+        # StepError above, so the answer comes from a successful create_answer.
+        if (
+            self.answer_cache is not None
+            and tasks[-1:] == ["knowledge_base_search.create_answer"]
+            and result
+            and result.strip()
+        ):
+            self.answer_cache.store(question, history_context, result, vector)
 
         return result
 
-    async def execute_plan_async(self, plan: dict, kernel: Kernel) -> str:
+    def _plan_dependencies(self, tasks: list) -> list:
+        """
+        Given a list of tasks, return for each task the indexes of the earlier
+        tasks it depends on. A task depends on the last task that wrote each
+        variable it reads, and on earlier calls of the same function since
+        they share its chat history. Tasks without known inputs and outputs
+        depend on, and are depended on by, every other task.
+        """
+        dependencies = []
+        last_writer = {}
+        for index, task in enumerate(tasks):
+            io = self._function_io.get(task)
+            if io is None:
+                depends_on = set(range(index))
+            else:
+                reads, _ = io
+                depends_on = {last_writer[v] for v in reads if v in last_writer}
+                depends_on.update(
+                    i
+                    for i in range(index)
+                    if tasks[i] == task or self._function_io.get(tasks[i]) is None
+                )
+            dependencies.append(sorted(depends_on))
+
+            writes = io[1] if io is not None else ()
+            for variable in writes:
+                last_writer[variable] = index
+        return dependencies
+
+    async def execute_plan_async(
+        self, plan: dict, kernel: Kernel, on_token=None, session=None
+    ) -> str:
         """
-        Given a plan, execute each of the functions within the plan
-        from start to finish and output the result.
+        Given a plan, execute the functions within the plan and output the
+        result of the last one. Functions that do not depend on each other
+        run concurrently, and their outputs are merged in plan order. If
+        on_token is given, the output of the last function is streamed to it.
         """
 
         # Create a context for the plan
@@ -90,49 +501,191 @@ class Orchestrator:
 
         # Default result
         result = "I am sorry. I could not find an answer to your question."
-        # Execute each function in the plan
-        for subtask in plan["tasks"]:
-            plugin_name, function_name = subtask.split(".")
-            sk_function = kernel.skills.get_function(plugin_name, function_name)
-            if subtask == "knowledge_base_search.create_answer":
-                # If create_answer is used, add a chat history maintenance step
-                output = await sk_function.invoke_async(variables=context)
-                await self.maintain_chat_history(
-                    context["user_input"], 2, output.result
+        tasks = plan["tasks"]
+        if not tasks:
+            return result
+
+        dependencies = self._plan_dependencies(tasks)
+        ancestors = []
+        for index in range(len(tasks)):
+            step_ancestors = set(dependencies[index])
+            for i in dependencies[index]:
+                step_ancestors.update(ancestors[i])
+            ancestors.append(sorted(step_ancestors))
+
+        # Skip create_search_query if the planner already created the query
+        outputs = {}
+        if plan.get("search_query"):
+            for index, subtask in enumerate(tasks):
+                if subtask == "knowledge_base_search.create_search_query":
+                    outputs[index] = {"input": plan["search_query"]}
+                    break
+        # Let the first search use the speculative search
+        speculations = {}
+        if plan.get("speculative_search") is not None:
+            index = tasks.index("acs_plugin.search")
+            speculations[index] = plan["speculative_search"]
+
+        steps = []
+        for index, subtask in enumerate(tasks):
+            steps.append(
+                asyncio.ensure_future(
+                    self._execute_step_async(
+                        subtask,
+                        context,
+                        [steps[i] for i in dependencies[index]],
+                        [steps[i] for i in ancestors[index]],
+                        kernel,
+                        on_token if index == len(tasks) - 1 else None,
+                        session,
+                        outputs.get(index),
+                        speculations.get(index),
+                    )
                 )
-            elif subtask == "knowledge_base_search.safety_share":
-                # context["user_input"] = "please share a safety tip"
-                output = await sk_function.invoke_async(variables=context)
+            )
+        try:
+            outputs = await asyncio.gather(*steps)
+        except BaseException:
+            for step in steps:
+                step.cancel()
+            raise
 
-            else:
-                output = await sk_function.invoke_async(variables=context)
+        # Merge the outputs back in plan order
+        for variables in outputs:
+            for name, value in variables.items():
+                context[name] = value
 
-            if subtask == "knowledge_base_search.create_search_query":
-                print(f"  |Backend: Query KB|: {output.result}\n")
+        # Return the output of the last function
+        return outputs[-1]["input"]
 
-            # Return the output of the last function
-            result = output.result
+    async def _execute_step_async(
+        self,
+        subtask: str,
+        base_context: ContextVariables,
+        dependencies: list,
+        ancestors: list,
+        kernel: Kernel,
+        on_token=None,
+        session=None,
+        precomputed: dict = None,
+        speculation: dict = None,
+    ) -> dict:
+        """
+        Execute one function of a plan once the functions it depends on have
+        finished, and return the variables it wrote. If on_token is given and
+        the function supports it, its output is streamed to on_token. If
+        precomputed variables are given, the function is not called. A search
+        uses the speculative search, if given, when it searched for the same
+        query.
+        """
+        if dependencies:
+            await asyncio.gather(*dependencies)
 
-        return result
+        # Build the context seen by this function from the original request
+        # and the outputs of the functions before it, in plan order
+        context = base_context.clone()
+        for ancestor in ancestors:
+            for name, value in ancestor.result().items():
+                context[name] = value
+
+        if precomputed is None and speculation is not None:
+            precomputed = await self._speculative_search_result(
+                speculation, context["input"]
+            )
+
+        if precomputed is not None:
+            variables = dict(precomputed)
+            result = variables["input"]
+        else:
+            plugin_name, function_name = subtask.split(".")
+            sk_function = None
+            if session is not None:
+                sk_function = session.get_function(plugin_name, function_name)
+            if sk_function is None:
+                sk_function = kernel.skills.get_function(plugin_name, function_name)
+            with tracing.span(function_name) as span:
+                if sk_function.is_semantic:
+                    span.set(
+                        "prompt_tokens",
+                        self._estimate_prompt_tokens(subtask, context, session),
+                    )
+                if on_token is not None and subtask in STREAMING_FUNCTIONS:
+                    # Pass a context to see the errors of the stream, which the
+                    # semantic kernel records instead of raising
+                    output = kernel.create_new_context()
+                    output.variables.merge_or_overwrite(context, overwrite=True)
+                    chunks = []
+                    async for chunk in sk_function.invoke_stream_async(
+                        context=output
+                    ):
+                        if not chunks and chunk.startswith(STREAM_ROLE_PREFIX):
+                            chunk = chunk[len(STREAM_ROLE_PREFIX) :]
+                        chunks.append(chunk)
+                        if chunk:
+                            on_token(chunk)
+                    if output.error_occurred:
+                        raise StepError(
+                            f"{subtask} failed: {output.last_error_description}"
+                        )
+                    result = "".join(chunks)
+                    variables = {}
+                else:
+                    output = await sk_function.invoke_async(variables=context)
+                    if output.error_occurred:
+                        raise StepError(
+                            f"{subtask} failed: {output.last_error_description}"
+                        )
+                    result = output.result
+                    io = self._function_io.get(subtask)
+                    writes = io[1] if io is not None else ("input",)
+                    variables = {
+                        name: output.variables[name]
+                        for name in writes
+                        if output.variables.contains_key(name)
+                    }
+                if sk_function.is_semantic:
+                    span.set("completion_tokens", count_tokens(result))
+
+        if subtask == "knowledge_base_search.create_answer":
+            # If create_answer is used, add a chat history maintenance step
+            await self.maintain_chat_history(
+                context["user_input"], 2, result, session
+            )
+
+        if subtask == "knowledge_base_search.create_search_query":
+            print(f"  |Backend: Query KB|: {result}\n")
+
+        variables["input"] = result
+        return variables
+
+    def _chat_function_config_for(self, session=None):
+        """Return the config of create_answer, with the session's history."""
+        if session is not None:
+            return session.chat_function_config
+        return self._chat_function_config
 
     async def maintain_chat_history(
         self,
         last_user_input: str,
         num_messages_to_pop: int,
         last_assistant_message: str = "",
+        session=None,
     ) -> str:
         """
         Maintain a chat history. This is used to remove the search results
         from user messages.
         """
-        if self._chat_function_config is not None:
+        chat_function_config = self._chat_function_config_for(session)
+        if chat_function_config is not None:
             for i in range(num_messages_to_pop):
                 # Remove the last n messages
-                self._chat_function_config.prompt_template._messages.pop()
+                chat_function_config.prompt_template._messages.pop()
 
             # Add the last user message without the search results
-            self._chat_function_config.prompt_template.add_user_message(last_user_input)
+            chat_function_config.prompt_template.add_user_message(last_user_input)
             # Add the last assistant message
-            self._chat_function_config.prompt_template.add_assistant_message(
+            chat_function_config.prompt_template.add_assistant_message(
                 last_assistant_message
             )
+            if self._history_compactor is not None:
+                self._history_compactor.compact(chat_function_config.prompt_template)
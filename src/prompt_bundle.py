@@ -0,0 +1,75 @@
+# This file contains the prompt bundle, a single JSON file with the prompt and
+# config files of all semantic functions. Loading the bundle replaces reading
+# and checking every prompt directory at startup. Rebuild it after changing a
+# prompt. To build it: python prompt_bundle.py --output ../.cache/prompt_bundle.json
+
+import argparse
+import json
+import os
+
+# File contents by path, and the directories of the files, of the loaded bundle
+_files = {}
+_directories = set()
+
+
+def build_prompt_bundle(parent_directory: str, semantic_plugins: dict, path: str):
+    """
+    Writes the files of the semantic functions to a bundle, and returns the
+    number of files.
+    """
+    files = {}
+    for plugin_directory_name, function_directory_list in semantic_plugins.items():
+        for function_directory_name in function_directory_list:
+            function_directory = os.path.join(
+                parent_directory, plugin_directory_name, function_directory_name
+            )
+            for file_name in sorted(os.listdir(function_directory)):
+                file_path = os.path.join(function_directory, file_name)
+                with open(file_path, "r") as f:
+                    files[file_path] = f.read()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"files": files}, f)
+    os.replace(temp_path, path)
+    return len(files)
+
+
+def load_prompt_bundle(path: str) -> int:
+    """
+    Loads a bundle in one read, and returns the number of files.
+    """
+    with open(path, "r") as f:
+        files = json.load(f)["files"]
+    _files.update(files)
+    _directories.update(os.path.dirname(file_path) for file_path in files)
+    return len(files)
+
+
+def read_bundled_file(path: str) -> str:
+    """Returns the content of a bundled file, or None if it is not bundled."""
+    return _files.get(path)
+
+
+def path_exists(path: str) -> bool:
+    """Returns whether a file or directory is bundled or exists on disk."""
+    return path in _files or path in _directories or os.path.exists(path)
+
+
+if __name__ == "__main__":
+    from app import PLUGIN_PARENT_DIRECTORY, SEMANTIC_PLUGINS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="../.cache/prompt_bundle.json",
+        help="path of the bundle to write",
+    )
+    args = parser.parse_args()
+
+    count = build_prompt_bundle(PLUGIN_PARENT_DIRECTORY, SEMANTIC_PLUGINS, args.output)
+    print(f"Wrote {count} files to {args.output}")
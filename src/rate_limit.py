@@ -0,0 +1,379 @@
+# This file contains the rate limiting of the Azure OpenAI calls. The chat
+# service, the search plugins and the data preparation script share one limiter
+# per deployment, which spaces the requests to stay under the requests and
+# tokens per minute quota, adapts its concurrency to 429 responses (additive
+# increase, multiplicative decrease) and retries throttled and failed requests
+# with jittered backoff.
+
+import asyncio
+import itertools
+import random
+import threading
+import time
+
+import tracing
+
+# HTTP statuses worth retrying: throttling and transient server errors
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+# Errors without a status worth retrying, e.g. of the openai package and aiohttp
+RETRYABLE_ERRORS = (
+    "Timeout",
+    "TimeoutError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "TryAgain",
+    "ClientConnectionError",
+    "ServerDisconnectedError",
+)
+# How often a request waiting for a free slot checks again, in seconds
+SLOT_POLL_INTERVAL = 0.02
+
+
+def _causes(error: BaseException):
+    """
+    Yield an error and the errors it wraps, e.g. the openai error wrapped in
+    the exception of the semantic kernel.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = (
+            getattr(error, "inner_exception", None)
+            or error.__cause__
+            or error.__context__
+        )
+
+
+def error_status(error: BaseException):
+    """Return the HTTP status of a failed request, or None."""
+    for cause in _causes(error):
+        for name in ("http_status", "status_code", "status"):
+            status = getattr(cause, name, None)
+            if isinstance(status, int):
+                return status
+    return None
+
+
+def retry_after_seconds(error: BaseException):
+    """
+    Return how long the service asked to wait before retrying, from the
+    retry-after-ms or Retry-After header of a failed request, or None.
+    """
+    for cause in _causes(error):
+        headers = getattr(cause, "headers", None)
+        if not headers:
+            continue
+        headers = {str(name).lower(): value for name, value in headers.items()}
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            # e.g. an HTTP date, use the backoff instead
+            return None
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return any(
+        isinstance(cause, asyncio.TimeoutError)
+        or type(cause).__name__ in RETRYABLE_ERRORS
+        for cause in _causes(error)
+    )
+
+
+class TokenBucket:
+    """
+    Allows an amount per minute, e.g. of requests or tokens, in bursts of up
+    to its capacity.
+    """
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60
+        # Azure enforces the quota over short windows, so only allow bursts of
+        # about 10 seconds of quota
+        self.capacity = capacity or max(1.0, per_minute / 6)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Return how long to wait until an amount is available."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """Give back an unused amount, or take more if negative."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Limits the requests to a deployment to its requests and tokens per minute,
+    if given, and to a number of concurrent requests that is halved when the
+    service throttles and grows back by one per round of successful requests.
+    It can be used from threads and from event loops.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rpm: float = None,
+        tpm: float = None,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = float(max_concurrency)
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Set from Retry-After, no request is sent before it
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failed": 0,
+            "wait_seconds": 0.0,
+            "peak_in_flight": 0,
+        }
+
+    def configure(self, rpm: float = None, tpm: float = None, max_concurrency=None):
+        """
+        Update the limits that are given. A bucket is only replaced when its
+        rate changes, as a new bucket starts full.
+        """
+        with self._lock:
+            if rpm and (self._requests is None or self._requests.rate != rpm / 60):
+                self._requests = TokenBucket(rpm)
+            if tpm and (self._tokens is None or self._tokens.rate != tpm / 60):
+                self._tokens = TokenBucket(tpm)
+            if max_concurrency:
+                self.max_concurrency = int(max_concurrency)
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Take a slot and the quota of a request, or return how long to wait
+        before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._paused_until > now:
+                return self._paused_until - now
+            if self._in_flight >= int(self.concurrency):
+                return SLOT_POLL_INTERVAL
+            delay = 0.0
+            if self._requests is not None:
+                delay = max(delay, self._requests.delay(1, now))
+            if self._tokens is not None:
+                delay = max(delay, self._tokens.delay(tokens, now))
+            if delay > 0:
+                return delay
+            if self._requests is not None:
+                self._requests.take(1, now)
+            if self._tokens is not None:
+                self._tokens.take(tokens, now)
+            self._in_flight += 1
+            self._stats["requests"] += 1
+            self._stats["peak_in_flight"] = max(
+                self._stats["peak_in_flight"], self._in_flight
+            )
+            return 0.0
+
+    def _waited(self, start: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._stats["wait_seconds"] += now - start
+        return now
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """
+        Wait until a request of an estimated number of tokens can be sent, and
+        return the time it starts. Call release when it is done.
+        """
+        start = time.monotonic()
+        delay = self._try_acquire(tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._try_acquire(tokens)
+        return self._waited(start)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocking version of acquire_async, for threads."""
+        start = time.monotonic()
+        delay = self._try_acquire(tokens)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self._try_acquire(tokens)
+        return self._waited(start)
+
+    def release(self, tokens: int = 0, used: int = None, success: bool = True):
+        """
+        Free the slot of a request, correct its token estimate with the tokens
+        it used, if known, and grow the concurrency after a success.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if used is not None and self._tokens is not None:
+                self._tokens.adjust(tokens - used)
+            if success:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+
+    def _throttled(self, started: float, retry_after: float = None):
+        with self._lock:
+            now = time.monotonic()
+            self._stats["throttled"] += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            # Requests sent before the last decrease were throttled by the same
+            # overload, only halve once for them
+            if started >= self._last_decrease:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self._last_decrease = now
+
+    def retry_delay(self, error: Exception, attempt: int, started: float):
+        """
+        Return how long to wait before retrying a failed request, or None if it
+        should not be retried.
+        """
+        if attempt >= self.max_retries or not is_retryable(error):
+            with self._lock:
+                self._stats["failed"] += 1
+            return None
+        status = error_status(error)
+        retry_after = retry_after_seconds(error)
+        if status == 429:
+            self._throttled(started, retry_after)
+        if retry_after is not None:
+            # Spread the retries of the requests throttled together
+            delay = retry_after + random.uniform(0, self.base_delay)
+        else:
+            delay = random.uniform(
+                0, min(self.max_delay, self.base_delay * 2**attempt)
+            )
+        with self._lock:
+            self._stats["retries"] += 1
+        span = tracing.current_span()
+        if span is not None:
+            span.add("retries")
+        print(
+            f"  |Backend: Rate limit|: {self.name} "
+            f"{status or type(error).__name__}, retrying in {delay:.1f}s"
+        )
+        return delay
+
+    async def call_async(self, func, tokens: int = 0, usage=None):
+        """
+        Call an async function sending one request within the limits, retrying
+        it when it fails. usage can return the tokens used from the result.
+        """
+        for attempt in itertools.count():
+            started = await self.acquire_async(tokens)
+            try:
+                result = await func()
+            except BaseException as e:
+                self.release(tokens, success=False)
+                delay = None
+                if isinstance(e, Exception):
+                    delay = self.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+            else:
+                self.release(tokens, usage(result) if usage else None)
+                return result
+            await asyncio.sleep(delay)
+
+    def call(self, func, tokens: int = 0, usage=None):
+        """Blocking version of call_async, for threads."""
+        for attempt in itertools.count():
+            started = self.acquire(tokens)
+            try:
+                result = func()
+            except Exception as e:
+                self.release(tokens, success=False)
+                delay = self.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+            else:
+                self.release(tokens, usage(result) if usage else None)
+                return result
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = self._in_flight
+            stats["concurrency"] = round(self.concurrency, 2)
+            stats["max_concurrency"] = self.max_concurrency
+            stats["rpm"] = self._requests.rate * 60 if self._requests else None
+            stats["tpm"] = self._tokens.rate * 60 if self._tokens else None
+        return stats
+
+
+# The limiters of the process, by deployment
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(
+    deployment: str, rpm: float = None, tpm: float = None, max_concurrency=None
+) -> RateLimiter:
+    """
+    Return the limiter shared by all calls to a deployment, updating the
+    limits that are given.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(deployment)
+        if limiter is None:
+            limiter = _limiters[deployment] = RateLimiter(deployment)
+    limiter.configure(rpm, tpm, max_concurrency)
+    return limiter
+
+
+def limits_from_settings(config: dict, prefix: str) -> dict:
+    """
+    Return the limits of a deployment from the settings, e.g.
+    AZURE_OPENAI_CHATGPT_RPM and AZURE_OPENAI_CHATGPT_TPM for the prefix
+    AZURE_OPENAI_CHATGPT. Unset limits are None.
+    """
+    limits = {}
+    for name in ("rpm", "tpm", "max_concurrency"):
+        value = config.get(f"{prefix}_{name.upper()}")
+        limits[name] = float(value) if value else None
+    return limits
+
+
+def stats() -> dict:
+    """Return the statistics of all limiters, by deployment."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in sorted(limiters.items())}
@@ -0,0 +1,80 @@
+# This file contains local intent routers that map a request directly to one of
+# the plans the planner produces, so that common requests can skip the planner.
+
+import re
+
+# The plans the planner is prompted to produce
+KB_SEARCH_PLAN = [
+    "knowledge_base_search.create_search_query",
+    "acs_plugin.search",
+    "knowledge_base_search.create_answer",
+]
+SAFETY_SHARE_PLAN = ["knowledge_base_search.safety_share"]
+EMPTY_PLAN = []
+
+# Keyword patterns per plan. A request is routed only when exactly one plan
+# matches, everything else falls back to the planner.
+DEFAULT_RULES = [
+    (
+        KB_SEARCH_PLAN,
+        [
+            r"\b(health|healthcare|medical|dental|vision|eye|prescriptions?)\b",
+            r"\b(plans?|cover(s|ed|age)?|benefits?|insurance|deductibles?)\b",
+            r"\b(co-?pays?|co-?insurance|premiums?|out-of-pocket|in-network)\b",
+            r"\b(northwind|perks ?plus|handbook|employees?|policy|policies)\b",
+            r"\b(pto|vacation|leave|holidays?|sick days?|time off|payroll)\b",
+            r"\b(roles?|manager|responsibilities|performance review)\b",
+            r"\b(more details|tell me more|elaborate|what about|how about)\b",
+        ],
+    ),
+    (
+        SAFETY_SHARE_PLAN,
+        [
+            r"\b(jokes?|funny|riddles?|poems?|stor(y|ies)|entertain\w*)\b",
+            r"\bsafety (tip|share|message)s?\b",
+        ],
+    ),
+    (
+        EMPTY_PLAN,
+        [
+            r"\b(weather|forecast|stock price|sports? scores?|recipes?)\b",
+        ],
+    ),
+]
+
+
+class KeywordRouter:
+    """
+    Routes a request to a plan with keyword patterns. Any object with a
+    route(request) method returning a plan or None can be used as a router.
+    """
+
+    def __init__(self, rules: list = None, min_matches: int = 1):
+        rules = DEFAULT_RULES if rules is None else rules
+        self._rules = [
+            (list(plan), [re.compile(p, re.IGNORECASE) for p in patterns])
+            for plan, patterns in rules
+        ]
+        self._min_matches = min_matches
+        self.routed = 0
+        self.fallbacks = 0
+
+    def route(self, request: str):
+        """
+        Return the plan for the request, or None when not confident.
+        """
+        matched = [
+            (plan, sum(1 for pattern in patterns if pattern.search(request)))
+            for plan, patterns in self._rules
+        ]
+        matched = [(plan, n) for plan, n in matched if n > 0]
+
+        if len(matched) == 1 and matched[0][1] >= self._min_matches:
+            self.routed += 1
+            return list(matched[0][0])
+
+        self.fallbacks += 1
+        return None
+
+    def stats(self) -> dict:
+        return {"routed": self.routed, "fallbacks": self.fallbacks}
@@ -0,0 +1,200 @@
+# This is an asyncio HTTP/WebSocket server that serves many concurrent chat
+# sessions from a single semantic kernel. Each session has its own chat history.
+# Before running the server, create a .env file based on .env.example in the
+# root directory. To run the server, simply run: python server.py --port 8080
+#
+# Endpoints:
+#   POST   /sessions                      create a session
+#   POST   /sessions/{session_id}/messages  send {"input": "..."}, get the answer
+#   GET    /sessions/{session_id}/ws        chat over a WebSocket, tokens streamed
+#   DELETE /sessions/{session_id}           end a session
+#   GET    /stats                         session, cache, pool, context and rate
+#                                         limit statistics
+#   GET    /metrics                       step latency histograms, in the Prometheus
+#                                         text format, or as JSON lines with
+#                                         ?format=jsonl
+
+import argparse
+import asyncio
+
+from aiohttp import WSMsgType, web
+
+import rate_limit
+from app import SEMANTIC_PLUGINS, PLUGIN_PARENT_DIRECTORY, create_app, warm_up
+from sessions import SessionManager
+from settings import is_enabled, load_settings
+
+
+async def run_turn(app: web.Application, session, user_input: str, on_token=None):
+    """
+    Process one user message of a session. Turns of the same session run one
+    at a time, turns of different sessions run concurrently.
+    """
+    async with session.lock:
+        answer = await app["orchestrator"].process_request_stream_async(
+            user_input, on_token, session
+        )
+        app["sessions"].end_turn(session)
+    return answer
+
+
+async def create_session(request: web.Request) -> web.Response:
+    session = request.app["sessions"].create()
+    return web.json_response({"session_id": session.session_id})
+
+
+async def delete_session(request: web.Request) -> web.Response:
+    if not request.app["sessions"].remove(request.match_info["session_id"]):
+        raise web.HTTPNotFound()
+    return web.json_response({"deleted": True})
+
+
+async def post_message(request: web.Request) -> web.Response:
+    body = await request.json()
+    user_input = body.get("input", "").strip()
+    if not user_input:
+        raise web.HTTPBadRequest(text="input is required")
+
+    session = request.app["sessions"].get(request.match_info["session_id"])
+    if session is None:
+        raise web.HTTPNotFound(text="session not found")
+    answer = await run_turn(request.app, session, user_input)
+    return web.json_response({"session_id": session.session_id, "answer": answer})
+
+
+async def chat_websocket(request: web.Request) -> web.WebSocketResponse:
+    session_id = request.match_info["session_id"]
+    if request.app["sessions"].get(session_id) is None:
+        raise web.HTTPNotFound(text="session not found")
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    async for message in ws:
+        if message.type != WSMsgType.TEXT:
+            continue
+        user_input = message.data.strip()
+        if not user_input:
+            continue
+        session = request.app["sessions"].get(session_id)
+        if session is None:
+            # The session was evicted or deleted while connected
+            await ws.send_json({"type": "error", "data": "session not found"})
+            break
+
+        # Send the tokens in order while the answer is generated
+        tokens = asyncio.Queue()
+
+        async def send_tokens():
+            while True:
+                token = await tokens.get()
+                if token is None:
+                    return
+                await ws.send_json({"type": "token", "data": token})
+
+        sender = asyncio.ensure_future(send_tokens())
+        try:
+            answer = await run_turn(request.app, session, user_input, tokens.put_nowait)
+        finally:
+            tokens.put_nowait(None)
+            await sender
+        await ws.send_json({"type": "answer", "data": answer})
+
+    return ws
+
+
+async def get_stats(request: web.Request) -> web.Response:
+    orchestrator = request.app["orchestrator"]
+    return web.json_response(
+        {
+            "sessions": request.app["sessions"].stats(),
+            "plan_cache": orchestrator.plan_cache.stats(),
+            "search_pool": request.app["search_plugin"].pool_stats(),
+            "search_cache": request.app["search_plugin"].search_cache_stats(),
+            "context_packing": request.app["search_plugin"].context_packer.stats(),
+            "answer_cache": (
+                orchestrator.answer_cache.stats()
+                if orchestrator.answer_cache is not None
+                else {}
+            ),
+            "speculative_search": orchestrator.speculation_stats(),
+            "rate_limits": rate_limit.stats(),
+        }
+    )
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    metrics = request.app["orchestrator"].tracer.metrics
+    if request.query.get("format") == "jsonl":
+        return web.Response(
+            text=metrics.to_json_lines(), content_type="application/x-ndjson"
+        )
+    return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+
+async def start_background_tasks(app: web.Application):
+    app["eviction"] = asyncio.ensure_future(app["sessions"].run_eviction())
+    if is_enabled(load_settings(), "WARM_UP"):
+        await warm_up(app["search_plugin"])
+
+
+async def cleanup(app: web.Application):
+    app["eviction"].cancel()
+    # Release the pooled search connections
+    await app["search_plugin"].close()
+
+
+def create_server(max_sessions, idle_timeout, max_history_messages) -> web.Application:
+    kernel_app = create_app()
+
+    app = web.Application()
+    app["orchestrator"] = kernel_app["orchestrator"]
+    app["search_plugin"] = kernel_app["search_plugin"]
+    app["sessions"] = SessionManager(
+        kernel_app["kernel"],
+        SEMANTIC_PLUGINS,
+        PLUGIN_PARENT_DIRECTORY,
+        max_sessions=max_sessions,
+        idle_timeout=idle_timeout,
+        max_history_messages=max_history_messages,
+    )
+    app.add_routes(
+        [
+            web.post("/sessions", create_session),
+            web.post("/sessions/{session_id}/messages", post_message),
+            web.get("/sessions/{session_id}/ws", chat_websocket),
+            web.delete("/sessions/{session_id}", delete_session),
+            web.get("/stats", get_stats),
+            web.get("/metrics", get_metrics),
+        ]
+    )
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="host to bind")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument(
+        "--max_sessions", type=int, default=1000, help="maximum number of sessions"
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=1800,
+        help="seconds after which an idle session is evicted",
+    )
+    parser.add_argument(
+        "--max_history_messages",
+        type=int,
+        default=20,
+        help="chat history messages kept per function and session",
+    )
+    args = parser.parse_args()
+
+    web.run_app(
+        create_server(args.max_sessions, args.idle_timeout, args.max_history_messages),
+        host=args.host,
+        port=args.port,
+    )
@@ -0,0 +1,168 @@
+# This file contains the chat sessions used to serve many conversations from a
+# single kernel. Each session has its own copy of the chat semantic functions,
+# so that chat histories are not shared between conversations.
+
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+from semantic_kernel import Kernel
+
+import utils
+
+
+class ChatSession:
+    """
+    A conversation with its own chat semantic functions and chat history.
+    """
+
+    def __init__(self, session_id: str, functions: dict, function_configs: dict):
+        self.session_id = session_id
+        # Semantic functions and their configs, keyed by "plugin.function"
+        self.functions = functions
+        self.function_configs = function_configs
+        # Serializes the turns of the session, as they share the chat history
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
+        self.turns = 0
+
+    @property
+    def chat_function_config(self):
+        return self.function_configs.get("knowledge_base_search.create_answer")
+
+    def get_function(self, plugin_name: str, function_name: str):
+        return self.functions.get(f"{plugin_name}.{function_name}")
+
+    def trim_history(self, max_messages: int):
+        """
+        Keep the system message and at most the last max_messages messages in
+        the chat history of each function.
+        """
+        for function_config in self.function_configs.values():
+            messages = function_config.prompt_template._messages
+            system = [m for m in messages[:1] if m[0] == "system"]
+            history = messages[len(system) :]
+            if len(history) > max_messages:
+                messages[:] = system + history[len(history) - max_messages :]
+
+
+class SessionManager:
+    """
+    Creates, looks up and evicts chat sessions.
+    """
+
+    def __init__(
+        self,
+        kernel: Kernel,
+        semantic_plugins: dict,
+        parent_directory: str = "plugins",
+        max_sessions: int = 1000,
+        idle_timeout: float = 1800,
+        max_history_messages: int = 20,
+    ):
+        self._kernel = kernel
+        self._semantic_plugins = semantic_plugins
+        self._parent_directory = parent_directory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_history_messages = max_history_messages
+        self._sessions = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _create_functions(self):
+        """
+        Create a copy of each chat semantic function with an empty history.
+        """
+        functions, function_configs = {}, {}
+        for plugin_name, function_names in self._semantic_plugins.items():
+            for function_name in function_names:
+                function_config = utils.create_chat_semantic_function_config(
+                    self._kernel,
+                    self._parent_directory,
+                    plugin_name,
+                    function_name,
+                    "system_skprompt.txt",
+                    "user_skprompt.txt",
+                    "config.json",
+                )
+                key = f"{plugin_name}.{function_name}"
+                function_configs[key] = function_config
+                # Create the function without registering it in the kernel
+                functions[key] = self._kernel._create_semantic_function(
+                    plugin_name, function_name, function_config
+                )
+        return functions, function_configs
+
+    def create(self) -> ChatSession:
+        """
+        Create a session with a new ID.
+        """
+        session_id = uuid.uuid4().hex
+        functions, function_configs = self._create_functions()
+        session = ChatSession(session_id, functions, function_configs)
+        self._sessions[session_id] = session
+        # Evict the least recently used sessions above the limit
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        return session
+
+    def get(self, session_id: str):
+        """
+        Return the session with the given ID, or None if it does not exist or
+        was evicted. Sessions are only created by create.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        self._sessions.move_to_end(session_id)
+        session.last_active = time.monotonic()
+        return session
+
+    def remove(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    def end_turn(self, session: ChatSession):
+        """
+        Record a finished turn and cap the chat history of the session.
+        """
+        session.turns += 1
+        session.last_active = time.monotonic()
+        session.trim_history(self.max_history_messages)
+
+    def evict_idle(self) -> int:
+        """
+        Remove the sessions that have been idle for longer than idle_timeout.
+        """
+        now = time.monotonic()
+        idle = [
+            session_id
+            for session_id, session in self._sessions.items()
+            if now - session.last_active > self.idle_timeout
+            and not session.lock.locked()
+        ]
+        for session_id in idle:
+            del self._sessions[session_id]
+        self.evicted += len(idle)
+        return len(idle)
+
+    async def run_eviction(self, interval: float = 60):
+        """
+        Periodically evict idle sessions.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            if evicted:
+                print(f"Evicted {evicted} idle sessions")
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "evicted": self.evicted,
+        }
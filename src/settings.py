@@ -0,0 +1,24 @@
+# This file contains the settings of the app, read from the .env file once and
+# shared by the kernel setup and the plugins.
+
+import functools
+
+from dotenv import dotenv_values
+
+DEFAULT_ENV_PATH = "../.env"
+
+
+@functools.lru_cache(maxsize=None)
+def load_settings(path: str = DEFAULT_ENV_PATH) -> dict:
+    """
+    Returns the settings of the .env file, parsing it on the first call only.
+    """
+    return dotenv_values(path)
+
+
+def is_enabled(config: dict, name: str, default: bool = False) -> bool:
+    """Returns whether a true/false setting is set to true."""
+    value = config.get(name)
+    if value is None or value == "":
+        return default
+    return str(value).strip().lower() in ("1", "true", "yes")
@@ -0,0 +1,43 @@
+# This file contains the token counting shared by the chat history and search
+# context budgets.
+
+from functools import lru_cache
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING):
+    """
+    Returns the tiktoken encoding, or None if tiktoken is not installed or its
+    encoding file cannot be downloaded, e.g. offline. It is imported and loaded
+    on first use, as loading it takes a while.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(f"Error loading the {encoding_name} encoding, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """
+    Count the tokens of a text, estimating 4 characters per token if the
+    tiktoken encoding is not available.
+    """
+    encoding = get_encoding(encoding_name)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return estimate_tokens(text)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the tokens of a text from its length, 4 characters per token,
+    without tokenizing it, e.g. for metrics counted on every request.
+    """
+    return len(text) // 4 + 1
@@ -0,0 +1,288 @@
+# This file contains the tracing of requests through the orchestrator pipeline.
+# Each request is a trace with a span per step (planner, create_search_query,
+# create_embedding, search, create_answer, ...), and the spans are aggregated
+# into latency histograms that can be exported as JSON lines or in the
+# Prometheus text format.
+
+import contextlib
+import json
+import time
+import uuid
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = "copilot"
+
+# The trace and span of the running request. Tasks started by a request get a
+# copy of the context, so plugins can add to the spans of their caller.
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed step of a request, with attributes such as token counts, cache
+    hits and retries.
+    """
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, name: str, value):
+        self.attributes[name] = value
+
+    def add(self, name: str, amount=1):
+        """Add to a counter attribute, e.g. retries."""
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def to_dict(self, trace_start: float) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start - trace_start, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """The spans of one request."""
+
+    def __init__(self, tracer, request: str, session_id: str = None):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.request = request
+        self.session_id = session_id
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "session_id": self.session_id,
+            "request": self.request,
+            "timestamp": self.timestamp,
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "spans": [span.to_dict(self.start) for span in self.spans],
+        }
+
+    def summary(self) -> str:
+        """Return the wall time of the top-level spans, e.g. for logging."""
+        return ", ".join(
+            f"{span.name} {span.duration:.2f}s"
+            for span in self.spans
+            if span.parent_id is None and span.duration is not None
+        )
+
+
+def current_span():
+    """
+    Return the span of the running step, or None outside of a traced request.
+    """
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Time a step of the running request. Outside of a traced request the span
+    is not recorded, so plugins can always use it.
+    """
+    trace = _current_trace.get()
+    new_span = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.set("error", type(e).__name__)
+        raise
+    finally:
+        new_span.duration = time.perf_counter() - new_span.start
+        _current_span.reset(token)
+        if trace is not None:
+            trace.spans.append(new_span)
+            trace.tracer.metrics.observe(new_span)
+
+
+class LatencyHistogram:
+    """A cumulative histogram of durations, like a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Latency histograms and counters of the spans, aggregated by span name.
+    """
+
+    # Numeric span attributes that are summed into counters
+    COUNTERS = ("prompt_tokens", "completion_tokens", "retries")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.latency = defaultdict(lambda: LatencyHistogram(self.buckets))
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.cache = defaultdict(lambda: {"hit": 0, "miss": 0})
+        self.errors = defaultdict(int)
+
+    def observe(self, span: Span):
+        self.latency[span.name].observe(span.duration)
+        for name in self.COUNTERS:
+            if name in span.attributes:
+                self.counters[span.name][name] += span.attributes[name]
+        if "cache_hit" in span.attributes:
+            result = "hit" if span.attributes["cache_hit"] else "miss"
+            self.cache[span.name][result] += 1
+        if "error" in span.attributes:
+            self.errors[span.name] += 1
+
+    def to_json_lines(self) -> str:
+        """Return one JSON line per span name."""
+        lines = []
+        for name in sorted(self.latency):
+            histogram = self.latency[name]
+            record = {
+                "span": name,
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+                "buckets": dict(zip(map(str, histogram.buckets), histogram.counts)),
+                "errors": self.errors[name],
+            }
+            record.update(self.counters[name])
+            if name in self.cache:
+                record["cache"] = self.cache[name]
+            lines.append(json.dumps(record))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def to_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        prefix = METRIC_PREFIX
+        lines = [
+            f"# HELP {prefix}_span_duration_seconds Wall time of the pipeline steps.",
+            f"# TYPE {prefix}_span_duration_seconds histogram",
+        ]
+        for name in sorted(self.latency):
+            histogram = self.latency[name]
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(
+                    f'{prefix}_span_duration_seconds_bucket{{span="{name}",'
+                    f'le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'{prefix}_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} '
+                f"{histogram.count}"
+            )
+            lines.append(
+                f'{prefix}_span_duration_seconds_sum{{span="{name}"}} {histogram.sum}'
+            )
+            lines.append(
+                f'{prefix}_span_duration_seconds_count{{span="{name}"}} '
+                f"{histogram.count}"
+            )
+
+        lines += [
+            f"# HELP {prefix}_span_tokens_total Prompt and completion tokens.",
+            f"# TYPE {prefix}_span_tokens_total counter",
+        ]
+        for name in sorted(self.counters):
+            for kind in ("prompt", "completion"):
+                if f"{kind}_tokens" in self.counters[name]:
+                    lines.append(
+                        f'{prefix}_span_tokens_total{{span="{name}",kind="{kind}"}} '
+                        f'{self.counters[name][f"{kind}_tokens"]}'
+                    )
+
+        lines += [
+            f"# HELP {prefix}_span_cache_total Cache lookups of the pipeline steps.",
+            f"# TYPE {prefix}_span_cache_total counter",
+        ]
+        for name in sorted(self.cache):
+            for result, count in self.cache[name].items():
+                lines.append(
+                    f'{prefix}_span_cache_total{{span="{name}",result="{result}"}} '
+                    f"{count}"
+                )
+
+        lines += [
+            f"# HELP {prefix}_span_retries_total Retries of the pipeline steps.",
+            f"# TYPE {prefix}_span_retries_total counter",
+        ]
+        for name in sorted(self.counters):
+            if "retries" in self.counters[name]:
+                lines.append(
+                    f'{prefix}_span_retries_total{{span="{name}"}} '
+                    f'{self.counters[name]["retries"]}'
+                )
+
+        lines += [
+            f"# HELP {prefix}_span_errors_total Failed pipeline steps.",
+            f"# TYPE {prefix}_span_errors_total counter",
+        ]
+        for name in sorted(self.errors):
+            lines.append(
+                f'{prefix}_span_errors_total{{span="{name}"}} {self.errors[name]}'
+            )
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """
+    Starts a trace per request, keeps the most recent traces and appends each
+    finished trace as a JSON line to trace_path, if given.
+    """
+
+    def __init__(self, trace_path: str = None, max_traces: int = 100, buckets=None):
+        self.trace_path = trace_path
+        self.traces = deque(maxlen=max_traces)
+        self.metrics = Metrics(buckets or DEFAULT_BUCKETS)
+
+    @contextlib.contextmanager
+    def trace(self, request: str, session_id: str = None):
+        new_trace = Trace(self, request, session_id)
+        trace_token = _current_trace.set(new_trace)
+        span_token = _current_span.set(None)
+        try:
+            yield new_trace
+        finally:
+            new_trace.duration = time.perf_counter() - new_trace.start
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            self.traces.append(new_trace)
+            self.metrics.latency["request"].observe(new_trace.duration)
+            if self.trace_path is not None:
+                with open(self.trace_path, "a") as f:
+                    f.write(json.dumps(new_trace.to_dict()) + "\n")
@@ -1,8 +1,8 @@
 # This file contains utility functions.
 
+import functools
 import os
 
-from dotenv import dotenv_values
 from semantic_kernel.kernel import Kernel
 from semantic_kernel.semantic_functions.chat_prompt_template import ChatPromptTemplate
 from semantic_kernel.semantic_functions.prompt_template_config import (
@@ -13,6 +13,9 @@ from semantic_kernel.semantic_functions.semantic_function_config import (
 )
 from semantic_kernel.utils.validation import validate_skill_name
 
+import prompt_bundle
+from settings import load_settings
+
 
 def import_chat_semantic_plugin_from_directory(
     kernel: Kernel,
@@ -56,6 +59,40 @@ def import_chat_semantic_function_from_directory(
     """
     Imports a semantic function from a directory.
     """
+    function_config = create_chat_semantic_function_config(
+        kernel,
+        parent_directory,
+        plugin_directory_name,
+        function_directory_name,
+        system_prompt_file,
+        user_prompt_file,
+        config_file,
+    )
+
+    function = kernel.register_semantic_function(
+        skill_name=plugin_directory_name,
+        function_name=function_directory_name,
+        function_config=function_config,
+    )
+
+    result = {"function": function, "function_config": function_config}
+
+    return result
+
+
+def create_chat_semantic_function_config(
+    kernel: Kernel,
+    parent_directory: str,
+    plugin_directory_name: str,
+    function_directory_name: str,
+    system_prompt_file: str = None,
+    user_prompt_file: str = "user_skprompt.txt",
+    config_file: str = "config.json",
+) -> SemanticFunctionConfig:
+    """
+    Creates the config of a chat semantic function from a directory. Each call
+    returns a config with its own, empty chat history.
+    """
     CONFIG_FILE = config_file
     SYSTEM_PROMPT_FILE = system_prompt_file
     USER_PROMPT_FILE = user_prompt_file
@@ -66,52 +103,55 @@ def import_chat_semantic_function_from_directory(
         parent_directory, plugin_directory_name, function_directory_name
     )
 
-    if not os.path.exists(function_directory):
+    if not prompt_bundle.path_exists(function_directory):
         raise ValueError(f"plugin directory does not exist: {function_directory}")
 
     # Check if user prompt file exists
     user_prompt_path = os.path.join(function_directory, USER_PROMPT_FILE)
-    if not os.path.exists(user_prompt_path):
+    if not prompt_bundle.path_exists(user_prompt_path):
         raise ValueError(f"User prompt file does not exist: {user_prompt_path}")
 
     # Check if config file exists
     config_path = os.path.join(function_directory, CONFIG_FILE)
-    if not os.path.exists(config_path):
+    if not prompt_bundle.path_exists(config_path):
         raise ValueError(f"Config file does not exist: {config_path}")
 
     # Create prompt config
     config = PromptTemplateConfig()
-    with open(config_path, "r") as config_file:
-        config = config.from_json(config_file.read())
+    config = config.from_json(read_prompt_file(config_path))
+    # The chat service streams one response only if it is set
+    if config.completion.number_of_responses is None:
+        config.completion.number_of_responses = 1
 
     # Load user prompt template
-    with open(user_prompt_path, "r") as prompt_file:
-        template = ChatPromptTemplate(
-            prompt_file.read(), kernel.prompt_template_engine, config
-        )
+    template = ChatPromptTemplate(
+        read_prompt_file(user_prompt_path), kernel.prompt_template_engine, config
+    )
 
     # Add one-off system prompt to the beginning of the message.
     # Check if system prompt file exists if specified
     if SYSTEM_PROMPT_FILE is not None:
         system_prompt_path = os.path.join(function_directory, SYSTEM_PROMPT_FILE)
-        if not os.path.exists(system_prompt_path):
+        if not prompt_bundle.path_exists(system_prompt_path):
             raise ValueError(f"System prompt file does not exist: {system_prompt_path}")
         else:
-            with open(system_prompt_path, "r") as prompt_file:
-                template.add_system_message(prompt_file.read())
+            template.add_system_message(read_prompt_file(system_prompt_path))
 
     # Create semantic function config
-    function_config = SemanticFunctionConfig(config, template)
+    return SemanticFunctionConfig(config, template)
 
-    function = kernel.register_semantic_function(
-        skill_name=plugin_directory_name,
-        function_name=function_directory_name,
-        function_config=function_config,
-    )
-
-    result = {"function": function, "function_config": function_config}
 
-    return result
+@functools.lru_cache(maxsize=None)
+def read_prompt_file(path: str) -> str:
+    """
+    Reads a prompt or config file from the prompt bundle, if it was loaded,
+    or from disk, caching its content.
+    """
+    content = prompt_bundle.read_bundled_file(path)
+    if content is not None:
+        return content
+    with open(path, "r") as prompt_file:
+        return prompt_file.read()
 
 
 def azure_openai_gpt_settings_from_dot_env():
@@ -119,7 +159,7 @@ def azure_openai_gpt_settings_from_dot_env():
     Returns the Azure OpenAI GPT model settings from the .env file.
     """
     deployment, api_key, endpoint = None, None, None
-    config = dotenv_values("../.env")
+    config = load_settings()
     deployment = config.get("AZURE_OPENAI_GPT_DEPLOYMENT", None)
     api_key = config.get("AZURE_OPENAI_API_KEY", None)
     endpoint = config.get("AZURE_OPENAI_ENDPOINT", None)
@@ -132,12 +172,13 @@ def azure_openai_gpt_settings_from_dot_env():
     return deployment or "", api_key, endpoint
 
 
-def azure_openai_chatgpt_settings_from_dot_env():
+def azure_openai_chatgpt_settings_from_dot_env(config: dict = None):
     """
-    Returns the Azure OpenAI ChatGPT model settings from the .env file.
+    Returns the Azure OpenAI ChatGPT model settings from the .env file, or from
+    the given config.
     """
     deployment, api_key, endpoint = None, None, None
-    config = dotenv_values("../.env")
+    config = config if config is not None else load_settings()
     deployment = config.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT", None)
     api_key = config.get("AZURE_OPENAI_API_KEY", None)
     endpoint = config.get("AZURE_OPENAI_ENDPOINT", None)
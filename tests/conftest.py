@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules of the app are imported from src, as the app runs from there
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
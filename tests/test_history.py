@@ -0,0 +1,59 @@
+from history import SUMMARY_HEADER, ChatHistoryCompactor
+
+
+class Template:
+    def __init__(self, template: str):
+        self._template = template
+
+
+class ChatPromptTemplate:
+    def __init__(self, messages: list):
+        self._messages = [(role, Template(text)) for role, text in messages]
+
+    def add_system_message(self, text: str):
+        self._messages.append(("system", Template(text)))
+
+
+def compact(messages: list, token_budget: int) -> list:
+    compactor = ChatHistoryCompactor(token_budget=token_budget)
+    # One token per word
+    compactor.count_tokens = lambda text: len(text.split())
+    prompt_template = ChatPromptTemplate(messages)
+    compactor.compact(prompt_template)
+    return [(role, t._template) for role, t in prompt_template._messages]
+
+
+def test_keeps_history_within_budget():
+    messages = [("system", "be helpful"), ("user", "hi"), ("assistant", "hello")]
+    assert compact(messages, token_budget=10) == messages
+
+
+def test_cut_between_a_reply_and_its_question_keeps_whole_pairs():
+    # Three messages fit in the budget, but the third from the end is the
+    # reply to a question that does not fit
+    messages = [
+        ("system", "be helpful"),
+        ("user", "first question here"),
+        ("assistant", "first answer"),
+        ("user", "second question"),
+        ("assistant", "second answer"),
+    ]
+    compacted = compact(messages, token_budget=6)
+    assert compacted == [
+        ("system", "be helpful"),
+        ("system", f"{SUMMARY_HEADER}\n- first question here"),
+        ("user", "second question"),
+        ("assistant", "second answer"),
+    ]
+
+
+def test_keeps_last_pair_over_budget():
+    messages = [
+        ("user", "first question"),
+        ("assistant", "first answer"),
+        ("user", "a long second question"),
+        ("assistant", "a long second answer"),
+    ]
+    compacted = compact(messages, token_budget=2)
+    assert [role for role, _ in compacted] == ["system", "user", "assistant"]
+    assert compacted[1:] == messages[2:]